@@ -1 +1 @@
-from .decorators import observe_models
\ No newline at end of file
+from .decorators import observe, observe_models
\ No newline at end of file
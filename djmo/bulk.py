@@ -0,0 +1,158 @@
+"""
+Capture of the bulk writes that do not send `post_save`/`post_delete` signals:
+`QuerySet.bulk_create`, `QuerySet.update`, `QuerySet.bulk_update` and the raw fast-path delete.
+The `QuerySet` methods are wrapped while at least one observer captures them,
+the wrappers only add a lookup on the queryset model and never fall back to per-row signals.
+Django never takes the fast path to delete the rows of an observed model, because the observer receives
+its `post_delete` signal: `QuerySet.delete()` sends the signal for each row and the deletes are recorded
+as ordinary events, only the direct calls of `_raw_delete` are recorded as batch events.
+"""
+import threading
+
+import django
+from django.db.models.query import QuerySet
+
+try:
+    from django.db.models.query import ModelIterable
+except ImportError:
+    # Django < 1.9
+    ModelIterable = None
+
+from . import dispatch
+from .sql import internal_queries
+
+# model -> list of observers capturing its bulk writes
+_observers = dict()
+# name of QuerySet method -> original method, filled when the wrappers are installed
+_originals = dict()
+_lock = threading.Lock()
+
+
+def _observers_of(model):
+    """:return the observers that must receive a bulk write on `model` made now"""
+    if model not in _observers:
+        return []
+    return [observer for observer in dispatch.observing(model) if observer.capture_bulk]
+
+
+def _returns_instances(queryset):
+    """:return False for the querysets of `values()` and `values_list()`, whose rows are not model instances"""
+    iterable_class = getattr(queryset, '_iterable_class', None)
+    if iterable_class is not None:
+        return issubclass(iterable_class, ModelIterable)
+    # before Django 1.9 `values()` and `values_list()` return a `ValuesQuerySet`, the only one with `_fields`
+    return not hasattr(queryset, '_fields')
+
+
+def _cached_pks(queryset):
+    """
+    :return the primary keys of an already evaluated queryset of model instances,
+        None if it has not been evaluated or it returns values
+    """
+    if queryset._result_cache is None or not _returns_instances(queryset):
+        return None
+    return [obj.pk for obj in queryset._result_cache]
+
+
+def _bulk_create(self, objs, *args, **kwargs):
+    objs = _originals['bulk_create'](self, objs, *args, **kwargs)
+    observers = _observers_of(self.model)
+    if observers:
+        # the backend may not return the primary keys of the created rows
+        pks = [obj.pk for obj in objs if obj.pk is not None]
+        for observer in observers:
+            observer.batch_receiver('created', pks, len(objs), using=self.db)
+    return objs
+
+
+def _update(self, **kwargs):
+    observers = _observers_of(self.model)
+    # `update` empties the result cache, read it before
+    pks = _cached_pks(self) if observers else None
+    rows = _originals['update'](self, **kwargs)
+    if observers:
+        if pks is not None and len(pks) != rows:
+            # the rows have changed since the queryset was evaluated, the cached primary keys are not reliable
+            pks = None
+        query = str(self.query) if pks is None else None
+        for observer in observers:
+            observer.batch_receiver('updated', pks or [], rows, query, using=self.db)
+    return rows
+
+
+def _bulk_update(self, objs, *args, **kwargs):
+    objs = list(objs)
+    result = _originals['bulk_update'](self, objs, *args, **kwargs)
+    observers = _observers_of(self.model)
+    if observers:
+        pks = [obj.pk for obj in objs]
+        for observer in observers:
+            observer.batch_receiver('updated', pks, len(pks), using=self.db)
+    return result
+
+
+def _raw_delete(self, using, *args, **kwargs):
+    observers = _observers_of(self.model)
+    if not observers:
+        return _originals['_raw_delete'](self, using, *args, **kwargs)
+    pks = _cached_pks(self)
+    count = None
+    if django.VERSION < (1, 9):
+        # the number of deleted rows is not returned
+        with internal_queries():
+            count = self.using(using).count()
+    rows = _originals['_raw_delete'](self, using, *args, **kwargs)
+    if rows is not None:
+        count = rows
+    if pks is not None and len(pks) != count:
+        # the rows have changed since the queryset was evaluated, the cached primary keys are not reliable
+        pks = None
+    query = str(self.query) if pks is None else None
+    for observer in observers:
+        observer.batch_receiver('deleted', pks or [], count, query, using=using)
+    return rows
+
+
+_wrappers = {
+    'bulk_create': _bulk_create,
+    'update': _update,
+    'bulk_update': _bulk_update,
+    '_raw_delete': _raw_delete,
+}
+
+
+for _wrapper in _wrappers.values():
+    _wrapper.alters_data = True
+
+
+def _install():
+    for name, wrapper in _wrappers.items():
+        if hasattr(QuerySet, name):
+            _originals[name] = getattr(QuerySet, name)
+            setattr(QuerySet, name, wrapper)
+
+
+def _uninstall():
+    for name, original in _originals.items():
+        setattr(QuerySet, name, original)
+    _originals.clear()
+
+
+def capture(observer):
+    """start capturing the bulk writes on the model of `observer`"""
+    with _lock:
+        if not _observers:
+            _install()
+        _observers.setdefault(observer.model, []).append(observer)
+
+
+def release(observer):
+    """stop capturing the bulk writes on the model of `observer`"""
+    with _lock:
+        observers = _observers.get(observer.model, [])
+        if observer in observers:
+            observers.remove(observer)
+        if not observers:
+            _observers.pop(observer.model, None)
+        if not _observers and _originals:
+            _uninstall()
@@ -0,0 +1,108 @@
+"""
+Cache of the snapshots of the observed rows, shared by the tests of a run and optionally saved on disk
+to be reused by the next runs.
+A record is reused while the version of its row is unchanged: the value of a version field given by the user
+(e.g. a modification time), or else a checksum of the row computed by the database, see `djmo.fingerprint`.
+Snapshotting a queryset then reads only the primary keys and the versions of its rows, and the fields
+of the rows missing from the cache or changed.
+"""
+import os
+import pickle
+import tempfile
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+from .fingerprint import row_checksum
+
+
+class SnapshotCache(object):
+    """
+    Records keyed by model, database, observed fields and primary key, with the version of the row they were read at.
+
+        cache = SnapshotCache(path='.djmo-cache')
+        Observer(SoccerPlayer, cache=cache).observe_queryset(SoccerPlayer.objects.all())
+        cache.save()
+    """
+    def __init__(self, path=None, version_field=None):
+        """
+        :param path: the file of the cache, loaded now if it exists and written by `save`; in memory only if not given
+        :param version_field: the name of a field changing at every write of a row,
+            a checksum of the row computed by the database if not given
+        """
+        self.path = path
+        self.version_field = version_field
+        self.hits = 0
+        self.misses = 0
+        # (model label, database alias, field names, pk) -> (version, record)
+        self._entries = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as cache_file:
+                self._entries = pickle.load(cache_file)
+
+    def _versions(self, queryset, extractor):
+        """:return the queryset of `(pk, version)` of the rows, None if the versions are not available"""
+        if self.version_field is not None:
+            return queryset.order_by('pk').values_list('pk', self.version_field)
+        checksum = row_checksum(connections[queryset.db], queryset.model, extractor.names)
+        if checksum is None:
+            return None
+        return queryset.annotate(djmo_version=RawSQL(checksum, ())).order_by('pk').values_list('pk', 'djmo_version')
+
+    def rows(self, queryset, extractor, chunk_size=2000):
+        """
+        :return an iterator over `(pk, record)` of the rows of `queryset` in pk order,
+            the records missing from the cache or out of date are fetched by chunks and stored
+        """
+        versions = self._versions(queryset, extractor)
+        if versions is None:
+            rows = queryset.order_by('pk').values_list('pk', *extractor.names).iterator()
+            for row in rows:
+                yield row[0], row[1:]
+            return
+        label = "{}.{}".format(queryset.model._meta.app_label, queryset.model._meta.model_name)
+        using = queryset.db
+        chunk = []
+        for pk, version in versions.iterator():
+            chunk.append((pk, version))
+            if len(chunk) == chunk_size:
+                for row in self._records(label, using, extractor, chunk):
+                    yield row
+                chunk = []
+        for row in self._records(label, using, extractor, chunk):
+            yield row
+
+    def _records(self, label, using, extractor, versions):
+        entries = self._entries
+        keys = [(label, using, extractor.names, pk) for pk, _ in versions]
+        missing = [pk for key, (pk, version) in zip(keys, versions)
+                   if key not in entries or entries[key][0] != version]
+        fetched = extractor.fetch(missing, using) if missing else {}
+        self.misses += len(missing)
+        self.hits += len(versions) - len(missing)
+        missing = set(missing)
+        for key, (pk, version) in zip(keys, versions):
+            if pk in fetched:
+                entries[key] = (version, fetched[pk])
+            elif pk in missing:
+                # deleted since its version has been read
+                continue
+            yield pk, entries[key][1]
+
+    def clear(self):
+        self._entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self):
+        """write the cache to its file, replaced atomically"""
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, 'wb') as cache_file:
+            pickle.dump(self._entries, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,243 @@
+"""
+Aggregation of the writes made by other processes (web server workers, multiprocessing pools...).
+The observing process starts a `Collector` listening on a Unix datagram socket, whose path is exported
+in the environment variable `DJMO_COLLECTOR` so that the processes it starts inherit it.
+Worker processes call `install` (e.g. in a gunicorn `post_fork` hook or in a pool initializer):
+their `post_save` and `post_delete` signals are then sent to the collector as compact binary events,
+one datagram each, and merged into the counters of the observers connected with `collector=`.
+Sends block while the socket is full, up to `SEND_TIMEOUT`; each worker numbers its events, so that the events
+it could not send are detected by the collector from the gaps of the numbers and reported by `drain`.
+
+    with Collector() as collector:
+        with observe(SoccerPlayer, collector=collector) as observers:
+            run_workers()
+        observers[SoccerPlayer].number_of_objects_created  # the writes of the workers included
+"""
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+
+from django.apps import apps
+from django.db.models.signals import post_save, post_delete
+
+from .dispatch import _model_label
+from .events import KINDS
+
+ENVIRONMENT_VARIABLE = 'DJMO_COLLECTOR'
+# seconds a worker waits for room in the socket of the collector before dropping an event
+SEND_TIMEOUT = 1.0
+# kind, type of the primary key, length of the model label, length of the database alias,
+# process id and sequence number of the sender
+_HEADER = struct.Struct('!BBBBIQ')
+_INTEGER = struct.Struct('!q')
+_INTEGER_PK, _TEXT_PK = 0, 1
+# control datagrams of the collector, sent by the observing process to itself
+_DRAIN, _STOP = 254, 255
+_MAX_DATAGRAM = 65536
+
+# the socket of the worker process and the number of its next event, created again after a fork
+_sender = None
+_sender_pid = None
+_sequence = 0
+# the number of events that could not be sent, e.g. because the collector is not listening
+dropped = 0
+
+
+class EventsLost(AssertionError):
+    """raised when write events of the worker processes have not reached the collector"""
+
+
+def encode(kind, label, using, pk, sender=0, sequence=0):
+    """
+    :param sender: the process id of the worker
+    :param sequence: the number of the event among the events of the worker, from 0
+    :return the datagram of a write event, integer primary keys take 8 bytes, the others are sent as text
+    """
+    label = label.encode('utf-8')
+    using = (using or '').encode('utf-8')
+    if isinstance(pk, int) and -2 ** 63 <= pk < 2 ** 63:
+        pk_type, pk = _INTEGER_PK, _INTEGER.pack(pk)
+    else:
+        pk_type, pk = _TEXT_PK, str(pk).encode('utf-8')
+    return _HEADER.pack(KINDS.index(kind), pk_type, len(label), len(using), sender, sequence) + label + using + pk
+
+
+def decode(datagram):
+    """:return `(kind, label, using, pk, sender, sequence)` of the datagram of a write event"""
+    kind, pk_type, label_length, using_length, sender, sequence = _HEADER.unpack_from(datagram)
+    offset = _HEADER.size
+    label = datagram[offset:offset + label_length].decode('utf-8')
+    offset += label_length
+    using = datagram[offset:offset + using_length].decode('utf-8') or None
+    offset += using_length
+    if pk_type == _INTEGER_PK:
+        pk = _INTEGER.unpack_from(datagram, offset)[0]
+    else:
+        pk = datagram[offset:].decode('utf-8')
+    return KINDS[kind], label, using, pk, sender, sequence
+
+
+def send(kind, model, pk, using=None):
+    """send a write event to the collector of the environment, never raises"""
+    global _sender, _sender_pid, _sequence, dropped
+    address = os.environ.get(ENVIRONMENT_VARIABLE)
+    if not address:
+        return
+    if _sender_pid != os.getpid():
+        _sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _sender.settimeout(SEND_TIMEOUT)
+        _sender_pid = os.getpid()
+        _sequence = 0
+    sequence = _sequence
+    # numbered even if not sent, so that the collector sees the gap
+    _sequence += 1
+    try:
+        _sender.sendto(encode(kind, _model_label(model), using, pk, _sender_pid, sequence), address)
+    except OSError:
+        # full socket past the timeout or collector stopped: the writes of the worker must not fail
+        dropped += 1
+
+
+def _post_save(sender, instance, created=False, using=None, **kwargs):
+    send('created' if created else 'updated', sender, instance.pk, using)
+
+
+def _post_delete(sender, instance, using=None, **kwargs):
+    send('deleted', sender, instance.pk, using)
+
+
+def install(models=None):
+    """
+    Hook of the worker processes: send their writes to the collector of the environment.
+    Receivers are connected per model, `post_delete` receivers disable the fast deletes of the models.
+    :param models: the models whose writes are sent, all the installed models if not given
+    :return False if no collector is set in the environment
+    """
+    if not os.environ.get(ENVIRONMENT_VARIABLE):
+        return False
+    for model in models or apps.get_models():
+        post_save.connect(_post_save, model, weak=False,
+                          dispatch_uid="djmo_collector_post_save_{}".format(_model_label(model)))
+        post_delete.connect(_post_delete, model, weak=False,
+                            dispatch_uid="djmo_collector_post_delete_{}".format(_model_label(model)))
+    return True
+
+
+class Collector(object):
+    """
+    Receives the write events of the worker processes on a Unix datagram socket and merges them
+    into the registered observers, from a background thread.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: the path of the socket, in a new temporary directory if not given
+        """
+        self._directory = None
+        if path is None:
+            self._directory = tempfile.mkdtemp(prefix='djmo-')
+            path = os.path.join(self._directory, 'collector.sock')
+        self.path = path
+        self.received = 0
+        # the number of events detected as lost, see `drain`
+        self.lost = 0
+        # process id of a worker -> sequence number of its next event
+        self._sequences = dict()
+        # model label -> list of observers
+        self._observers = dict()
+        self._lock = threading.Lock()
+        # drain token -> threading.Event
+        self._drains = dict()
+        self._socket = None
+        self._sender = None
+        self._thread = None
+
+    def start(self):
+        """listen on the socket and export its path to the processes started from now on"""
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # room for bursts of events while the thread is not scheduled
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        self._socket.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        os.environ[ENVIRONMENT_VARIABLE] = self.path
+        self._thread = threading.Thread(target=self._receive, name="djmo-collector")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop listening, the events still in the socket are merged before"""
+        if self._thread is None:
+            return
+        self._sender.sendto(bytes([_STOP]), self.path)
+        self._thread.join()
+        self._thread = None
+        self._socket.close()
+        self._sender.close()
+        if os.environ.get(ENVIRONMENT_VARIABLE) == self.path:
+            del os.environ[ENVIRONMENT_VARIABLE]
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def register(self, observer):
+        with self._lock:
+            self._observers.setdefault(_model_label(observer.model), []).append(observer)
+
+    def unregister(self, observer):
+        with self._lock:
+            observers = self._observers.get(_model_label(observer.model), [])
+            if observer in observers:
+                observers.remove(observer)
+
+    def drain(self, timeout=5, check=True):
+        """
+        wait until the events sent before this call are merged: the socket keeps the order of the datagrams,
+        so a control datagram sent now is received after them
+        :param check: if True, raise `EventsLost` if events of the workers have been lost since the start;
+            the events lost after the last event received from a worker cannot be detected
+        :return False if the timeout expired
+        """
+        if self._thread is None or threading.current_thread() is self._thread:
+            return True
+        event = threading.Event()
+        token = id(event) & 0xFFFFFFFF
+        self._drains[token] = event
+        self._sender.sendto(bytes([_DRAIN]) + struct.pack('!I', token), self.path)
+        drained = event.wait(timeout)
+        self._drains.pop(token, None)
+        if check and self.lost:
+            raise EventsLost("{} write events of the worker processes have been lost, the counters "
+                             "of the observers are too low".format(self.lost))
+        return drained
+
+    def _receive(self):
+        while True:
+            datagram = self._socket.recv(_MAX_DATAGRAM)
+            if datagram[0] == _STOP:
+                return
+            if datagram[0] == _DRAIN:
+                event = self._drains.get(struct.unpack_from('!I', datagram, 1)[0])
+                if event is not None:
+                    event.set()
+                continue
+            self.received += 1
+            kind, label, using, pk, sender, sequence = decode(datagram)
+            expected = self._sequences.get(sender, 0)
+            # a lower number is a new process with the id of a finished one, it starts from 0
+            self.lost += sequence - expected if sequence >= expected else sequence
+            self._sequences[sender] = sequence + 1
+            for observer in self._observers.get(label, ()):
+                observer.collector_receiver(kind, pk, using)
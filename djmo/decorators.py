@@ -1,41 +1,80 @@
+import asyncio
+import sys
 from functools import wraps
 from .observer import Observer, ObserversList
 
 
-def observe_models(*models):
+class observe(object):
     """
-    Decorator used to add model observers to function/method decorated
+    Context manager observing the given models, with `with` or `async with`.
+    It gives the `ObserversList` of the models:
+
+        with observe(SoccerPlayer, SoccerTeam) as observers:
+            ...
+        observers[SoccerPlayer].number_of_objects_created
+
+    :param models: the models to be observed
+    :param options: keyword arguments given to each `Observer`, e.g. `batched=True`
+    """
+    def __init__(self, *models, **options):
+        self.observers = ObserversList()
+        for model in models:
+            self.observers[model] = Observer(model, queries=self.observers.queries, **options)
+
+    def __enter__(self):
+        for observer in self.observers.values():
+            observer.connect()
+        return self.observers
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # disconnect all observers in any case
+        for observer in self.observers.values():
+            observer.disconnect()
+        for model in self.observers.keys():
+            profiler = self.observers[model].profiler
+            if profiler is not None:
+                print(profiler.report("djmo write sites of {}".format(model.__name__)), file=sys.stderr)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return self.__exit__(exc_type, exc_value, traceback)
+
+
+def observe_models(*models, **options):
+    """
+    Decorator used to add model observers to function/method decorated, coroutines included
     :param models: the models to be observed
+    :param options: keyword arguments given to each `Observer`, e.g. `batched=True`
     """
+    def attach_observers(this, observers):
+        this.observers = observers
+        for observer in observers.values():
+            # add this.modelname_observer property
+            observer.monkey_patch_observer(this)
+        # add default observer
+        if len(models) == 1:
+            this.observer = observers[models[0]]
+
     def decorator(observed_method):
+        if asyncio.iscoroutinefunction(observed_method):
+            @wraps(observed_method)
+            async def async_wrapper(this, *args, **kwargs):
+                async with observe(*models, **options) as observers:
+                    attach_observers(this, observers)
+                    return await observed_method(this, *args, **kwargs)
+
+            return async_wrapper
+
         @wraps(observed_method)
         def wrapper(this, *args, **kwargs):
-            this.observers = ObserversList()
-            # connect signals
-            for model in models:
-                observer = Observer(model)
-                observer.connect()
-                this.observers[model] = observer
-                # add this.modelname_observer property
-                observer.monkey_patch_observer(this)
-            # add default observer
-            if len(models) == 1:
-                this.observer = this.observers[models[0]]
-
-            try:
-                # execute method itself
-                observed_method(this, *args, **kwargs)
-            except Exception:
-                raise
-            finally:
-                # disconnect all signals in any case
-                for observer in this.observers.values():
-                    observer.disconnect()
+            with observe(*models, **options) as observers:
+                attach_observers(this, observers)
+                return observed_method(this, *args, **kwargs)
 
         return wrapper
     return decorator
 
 
 # TODO self.observers.assertNothingHasChanged
-# TODO with statement
-# TODO add receiver to signal `m2m_changed`
@@ -0,0 +1,172 @@
+"""
+Module-level dispatcher of the write signals.
+The receivers of a model are connected the first time one of its observers is activated and stay connected,
+each signal is routed to the observers active in the current context.
+Active observers are kept in a `contextvars`-scoped stack, so that concurrent asyncio tasks observe
+only their own writes; on Python < 3.7 the stack is scoped to the current thread.
+Observers created with the `threads` option are instead kept in a process-wide registry
+and receive the writes made by the threads they observe.
+`m2m_changed` is routed to the observers of both sides of the relation.
+The same routing is used by the bulk and SQL captures, see `observing`.
+"""
+import threading
+
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+
+class _ThreadLocalStack(threading.local):
+    """fallback for `contextvars.ContextVar` on Python < 3.7"""
+    value = ()
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+if contextvars is not None:
+    _active = contextvars.ContextVar('djmo_active_observers', default=())
+else:
+    _active = _ThreadLocalStack()
+
+# model -> tuple of the observers with the `threads` option, replaced (never mutated) under `_lock`
+_threaded = dict()
+_lock = threading.Lock()
+_connected_models = set()
+# through model -> ManyToManyField, for the relations whose `m2m_changed` is connected
+_m2m_fields = dict()
+
+
+def _model_label(model):
+    return "{}.{}".format(model._meta.app_label, model._meta.model_name)
+
+
+def observing(model):
+    """
+    :return the observers of `model` that must receive a write made now, in the current context and thread
+    """
+    observers = [observer for observer in _active.get() if observer.model is model]
+    for observer in _threaded.get(model, ()):
+        if observer.observes_current_thread():
+            observers.append(observer)
+    return observers
+
+
+def _post_save(sender, **kwargs):
+    for observer in observing(sender):
+        if observer.backend == 'signals':
+            observer.save_receiver(sender, **kwargs)
+
+
+def _post_delete(sender, **kwargs):
+    for observer in observing(sender):
+        if observer.backend == 'signals':
+            observer.delete_receiver(sender, **kwargs)
+
+
+def _remote_field(field):
+    # `rel` has been renamed `remote_field` in Django 1.9
+    return getattr(field, 'remote_field', None) or field.rel
+
+
+def _relation_names(field):
+    """:return the names of a ManyToManyField on its model and on the related model"""
+    return field.name, _remote_field(field).get_accessor_name() or field.name
+
+
+def _m2m_changed(sender, instance, action, reverse, model, pk_set, using=None, **kwargs):
+    field_name, accessor_name = _relation_names(_m2m_fields[sender])
+    name, related_name = (accessor_name, field_name) if reverse else (field_name, accessor_name)
+    if action == 'pre_clear':
+        # the objects removed by a clear are not in the payload, they are read once if their side is observed
+        if observing(model):
+            from .sql import internal_queries
+            with internal_queries():
+                pks = set(getattr(instance, name).using(using).values_list('pk', flat=True))
+            instance.__dict__.setdefault('_djmo_cleared', dict())[sender] = pks
+        return
+    if not action.startswith('post_'):
+        return
+    change = action[len('post_'):]
+    for observer in observing(type(instance)):
+        observer.m2m_receiver(instance.pk, name, change, pk_set, using)
+    related_change = change
+    if change == 'clear':
+        # for the related objects a clear is the removal of the instance
+        pk_set = instance.__dict__.get('_djmo_cleared', {}).pop(sender, None)
+        related_change = 'remove'
+    if pk_set:
+        related_observers = observing(model)
+        for pk in pk_set:
+            for observer in related_observers:
+                observer.m2m_receiver(pk, related_name, related_change, {instance.pk}, using)
+
+
+def _m2m_relations(model):
+    """:return the ManyToManyFields of the forward and reverse many-to-many relations of `model`"""
+    return [field.field if field.auto_created else field
+            for field in model._meta.get_fields() if field.many_to_many]
+
+
+def _connect(model):
+    with _lock:
+        if model in _connected_models:
+            return
+        post_save.connect(_post_save, model, weak=False,
+                          dispatch_uid="djmo_post_save_{}".format(_model_label(model)))
+        post_delete.connect(_post_delete, model, weak=False,
+                            dispatch_uid="djmo_post_delete_{}".format(_model_label(model)))
+        # connected per through model: a listener without sender would disable fast deletes of every model
+        for field in _m2m_relations(model):
+            through = _remote_field(field).through
+            if through not in _m2m_fields:
+                m2m_changed.connect(_m2m_changed, through, weak=False,
+                                    dispatch_uid="djmo_m2m_changed_{}".format(_model_label(through)))
+                _m2m_fields[through] = field
+        _connected_models.add(model)
+
+
+def _disconnect(model):
+    """disconnect the receivers of `model`, they are connected again by the next activation of one of its observers"""
+    with _lock:
+        post_save.disconnect(sender=model, dispatch_uid="djmo_post_save_{}".format(_model_label(model)))
+        post_delete.disconnect(sender=model, dispatch_uid="djmo_post_delete_{}".format(_model_label(model)))
+        _connected_models.discard(model)
+
+
+def active_observers():
+    """:return the observers active in the current context, the most recently activated last"""
+    return _active.get()
+
+
+def activate(observer):
+    """
+    push `observer` on the stack of the current context,
+    or add it to the process-wide registry if it observes a set of threads
+    """
+    if observer.backend == 'signals':
+        _connect(observer.model)
+    if observer.threads is None:
+        _active.set(_active.get() + (observer,))
+    else:
+        with _lock:
+            _threaded[observer.model] = _threaded.get(observer.model, ()) + (observer,)
+
+
+def deactivate(observer):
+    """remove `observer` from the stack of the current context or from the process-wide registry"""
+    if observer.threads is None:
+        _active.set(tuple(active for active in _active.get() if active is not observer))
+    else:
+        with _lock:
+            observers = tuple(active for active in _threaded.get(observer.model, ()) if active is not observer)
+            if observers:
+                _threaded[observer.model] = observers
+            else:
+                _threaded.pop(observer.model, None)
@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict
+
+# the kinds of write events, in the order of the reports
+KINDS = ('created', 'updated', 'deleted')
+
+
+class EventStore(object):
+    """
+    The events of one kind (created, updated or deleted) received by an observer.
+    Primary keys are kept in an insertion-ordered set with a counter of events per pk,
+    so that counts and membership checks are O(1).
+    The raw ordered events are available in `log`.
+    Rows changed by bulk operations whose primary keys are unknown are only counted in `anonymous`.
+    Events can be recorded from several threads: writers hold a lock only for the update of the counters,
+    readers never take it.
+    """
+    def __init__(self):
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+        self.log = []
+        self.anonymous = 0
+
+    def add(self, pk):
+        """record an event for the primary key `pk`"""
+        with self._lock:
+            self._counters[pk] = self._counters.get(pk, 0) + 1
+        self.log.append(pk)
+
+    def add_anonymous(self, number_of_rows):
+        """record events for `number_of_rows` rows whose primary keys are unknown"""
+        with self._lock:
+            self.anonymous += number_of_rows
+
+    def count(self, pk):
+        """:return the number of events recorded for `pk`"""
+        return self._counters.get(pk, 0)
+
+    def clear(self):
+        self._counters.clear()
+        self.log = []
+        self.anonymous = 0
+
+    def __contains__(self, pk):
+        return pk in self._counters
+
+    def __len__(self):
+        """:return the number of distinct primary keys plus the anonymous rows"""
+        return len(self._counters) + self.anonymous
+
+    def __iter__(self):
+        """iterate over the distinct primary keys in order of first event"""
+        return iter(self._counters)
+
+
+class RelationDelta(object):
+    """
+    The net changes of a many-to-many relation of one instance, built from the `m2m_changed` payloads.
+    `added` and `removed` are sets of primary keys of the related objects,
+    `cleared` is True if the relation has been cleared (the objects removed by a clear are unknown on the side
+    of the clear; on the other side, if observed, they are read before the clear and recorded as removals).
+    """
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+        self.cleared = False
+
+    def add(self, pks):
+        for pk in pks:
+            if pk in self.removed:
+                self.removed.discard(pk)
+            else:
+                self.added.add(pk)
+
+    def remove(self, pks):
+        for pk in pks:
+            if pk in self.added:
+                self.added.discard(pk)
+            else:
+                self.removed.add(pk)
+
+    def clear(self):
+        self.added.clear()
+        self.cleared = True
+
+    @property
+    def has_changed(self):
+        return bool(self.added or self.removed or self.cleared)
+
+    def __repr__(self):
+        return "<RelationDelta added={} removed={} cleared={}>".format(
+            sorted(self.added), sorted(self.removed), self.cleared)
+
+
+class BatchEvent(object):
+    """
+    A write made by a bulk operation (`bulk_create`, `QuerySet.update`, raw delete) that does not send signals.
+    :param kind: 'created', 'updated' or 'deleted'
+    :param pks: the primary keys of the affected rows, when they could be found cheaply
+    :param count: the number of affected rows
+    :param filter: the SQL of the queryset, when the primary keys are unknown
+    """
+    def __init__(self, kind, pks, count, filter=None):
+        self.kind = kind
+        self.pks = pks
+        self.count = count
+        self.filter = filter
+
+    def __repr__(self):
+        return "<BatchEvent {} {} rows>".format(self.kind, self.count)
+
+
+class QuerySetDelta(object):
+    """
+    The changes of the rows of an observed queryset, see `Observer.observe_queryset`.
+    `created` and `deleted` are lists of primary keys, in ascending order,
+    `updated` is a dictionary `pk -> {field name: new value}`.
+    Rows entering or leaving the filter of the queryset count as created or deleted.
+    """
+    def __init__(self):
+        self.created = []
+        self.updated = dict()
+        self.deleted = []
+
+    @classmethod
+    def between(cls, old_records, new_records, diff):
+        """
+        :param old_records: a dictionary `pk -> record` of the snapshot
+        :param new_records: a dictionary `pk -> record` of the rows as they are now
+        :param diff: the function comparing an old record and a new one, e.g. `FieldExtractor.diff`
+        :return the `QuerySetDelta` between the two sets of records
+        """
+        delta = cls()
+        delta.created = sorted(pk for pk in new_records if pk not in old_records)
+        delta.deleted = sorted(pk for pk in old_records if pk not in new_records)
+        for pk, old_record in old_records.items():
+            if pk in new_records:
+                changes = diff(old_record, new_records[pk])
+                if changes:
+                    delta.updated[pk] = changes
+        return delta
+
+    @property
+    def has_changed(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    def __repr__(self):
+        return "<QuerySetDelta created={} updated={} deleted={}>".format(
+            len(self.created), len(self.updated), len(self.deleted))
+
+
+class GraphDelta(object):
+    """
+    The changes of an observed instance and of the objects related to it, see `Observer.graph_delta`.
+    `fields` is the delta of the instance, `related` a dictionary `relation name -> QuerySetDelta`
+    where created and deleted are the objects added to and removed from the relation,
+    `deleted` is True if the instance has been deleted.
+    """
+    def __init__(self):
+        self.fields = dict()
+        self.related = dict()
+        self.deleted = False
+
+    @property
+    def has_changed(self):
+        return bool(self.deleted or self.fields or any(delta.has_changed for delta in self.related.values()))
+
+    def __repr__(self):
+        return "<GraphDelta fields={} related={} deleted={}>".format(self.fields, self.related, self.deleted)
@@ -0,0 +1,83 @@
+"""
+Table-level fingerprints, to detect the writes made outside of the current process
+(workers, subprocesses, raw SQL) without reading the rows in Python.
+A fingerprint is computed by the database with one query: the number of rows, the maximum primary key
+and the sum of a checksum of the chosen columns of each row, primary key included.
+The checksum is CRC32 on SQLite (as a registered function) and MySQL, the first 32 bits of MD5 on PostgreSQL;
+on the other databases only the number of rows and the maximum primary key are compared.
+"""
+import zlib
+from collections import namedtuple
+
+from django.db import connections, router
+
+from .records import FieldExtractor
+from .sql import internal_queries
+
+Fingerprint = namedtuple('Fingerprint', ['count', 'max_pk', 'checksum'])
+
+_SEPARATOR = '\x1f'
+_NULL = 'NULL'
+
+
+def _crc32(*values):
+    text = _SEPARATOR.join(_NULL if value is None else str(value) for value in values)
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def _sqlite_checksum(connection, columns):
+    connection.ensure_connection()
+    # registering a function on a connection is cheap, it is done at every fingerprint
+    # so that connections opened later get it too
+    connection.connection.create_function('djmo_crc32', -1, _crc32)
+    return "djmo_crc32({})".format(", ".join(columns))
+
+
+def _postgresql_checksum(connection, columns):
+    values = ", ".join("COALESCE(CAST({} AS text), '{}')".format(column, _NULL) for column in columns)
+    return "('x' || substr(md5(concat_ws(chr(31), {})), 1, 8))::bit(32)::int".format(values)
+
+
+def _mysql_checksum(connection, columns):
+    values = ", ".join("COALESCE({}, '{}')".format(column, _NULL) for column in columns)
+    return "CRC32(CONCAT_WS(CHAR(31), {}))".format(values)
+
+
+_CHECKSUMS = {
+    'sqlite': _sqlite_checksum,
+    'postgresql': _postgresql_checksum,
+    'mysql': _mysql_checksum,
+}
+
+
+def row_checksum(connection, model, fields=None):
+    """
+    :param fields: names of the fields in the checksum, all the concrete fields if not given
+    :return the SQL expression of the checksum of a row of `model`, primary key included,
+        None if the database of `connection` is not supported
+    """
+    checksum = _CHECKSUMS.get(connection.vendor)
+    if checksum is None:
+        return None
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    columns = [model._meta.pk] + FieldExtractor.concrete_fields(model, fields)
+    return checksum(connection, ["{}.{}".format(table, quote_name(field.column)) for field in columns])
+
+
+def fingerprint(model, fields=None, using=None):
+    """
+    :param fields: names of the fields in the checksum, all the concrete fields if not given
+    :param using: the alias of the database, the database for reads of `model` if not given
+    :return the `Fingerprint` of the table of `model`
+    """
+    connection = connections[using or router.db_for_read(model)]
+    quote_name = connection.ops.quote_name
+    pk_column = quote_name(model._meta.pk.column)
+    checksum = row_checksum(connection, model, fields)
+    checksum = "SUM({})".format(checksum) if checksum is not None else "NULL"
+    with internal_queries(), connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*), MAX({}), {} FROM {}".format(
+            pk_column, checksum, quote_name(model._meta.db_table)))
+        count, max_pk, checksum = cursor.fetchone()
+    return Fingerprint(count, max_pk, int(checksum) if checksum is not None else None)
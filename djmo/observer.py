@@ -1,5 +1,26 @@
-from django.db.models.signals import post_save, post_delete
-from django.core import serializers
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import bulk, dispatch, sql, transactions
+from .profiling import WriteProfiler
+from .events import KINDS, BatchEvent, EventStore, GraphDelta, QuerySetDelta, RelationDelta
+from .fingerprint import fingerprint as table_fingerprint
+from .records import FieldExtractor, get_extractor, get_relation, model_of
+
+# last known record of an observed instance not maintained from the signals, it is re-fetched
+_UNTRACKED = object()
+
+
+def _fetch_in_thread(fetch, pks, using):
+    try:
+        return fetch(pks, using)
+    finally:
+        # the connections of the threads of the pool are not reused
+        connections[using].close()
 
 
 class ModelInstancePatched(object):
@@ -11,27 +32,86 @@ class ModelInstancePatched(object):
 
 
 class ModelInstanceObserved(object):
-    def __init__(self, instance):
-        self.model = type(instance)
+    # one per observed instance, slots keep it small
+    __slots__ = ('model', 'pk', 'using', 'extractor', 'record', 'digest', 'observer', 'related', 'current')
+
+    def __init__(self, instance, observer=None, extractor=None, digest=False, incremental=False):
+        """
+        :param extractor: the `FieldExtractor` of the fields to observe, all the concrete fields if not given
+        :param digest: if True, keep only the digest of the record, see `FieldExtractor.digest`
+        :param incremental: if True, keep the last known record of the instance, updated by `saved` and `deleted`
+        """
+        self.model = model_of(instance)
         self.pk = instance.pk
-        self.field_set = {(k, tuple(v)) if isinstance(v, list) else (k, v)
-                          for k, v in serializers.serialize('python', [instance])[0]['fields'].items()}
+        # the database the instance has been read from, re-fetches go to the same database
+        self.using = instance._state.db
+        self.extractor = extractor or get_extractor(self.model)
+        self.record = self.extractor.record(instance)
+        # the last known record, None once deleted
+        self.current = self.record if incremental else _UNTRACKED
+        self.digest = digest
+        if digest:
+            self.record = self.extractor.digest(self.record)
+        # in batched mode the observer re-fetches all its observed instances at once
+        self.observer = observer if observer is not None and observer.batched else None
+        # RelationExtractor -> {related pk: record} of the followed relations, see `Observer.observe_instance`
+        self.related = dict()
+
+    def current_record(self):
+        """
+        :return the record of the instance as it is now in the database, None if it has been deleted
+        """
+        if self.current is not _UNTRACKED:
+            return self.current
+        if self.observer is not None:
+            return self.observer.current_records(self.extractor, self.using).get(self.pk)
+        return self.extractor.fetch([self.pk], self.using).get(self.pk)
 
     @property
     def delta(self):
-        current_instance = ModelInstanceObserved(self.model.objects.get(pk=self.pk))
-        # difference between two sets with - operator
-        delta_elements = current_instance.field_set - self.field_set
-        # return delta as dictionary
-        return {t[0]: t[1] for t in delta_elements}
+        current_record = self.current_record()
+        if current_record is None:
+            raise self.model.DoesNotExist("{} with pk {} has been deleted".format(self.model.__name__, self.pk))
+        return self.diff(current_record)
+
+    @property
+    def is_tracked(self):
+        """:return True if the delta is computed from the last known record, without querying the database"""
+        return self.current is not _UNTRACKED
+
+    def saved(self, instance, update_fields=None):
+        """
+        update the last known record with the values of the saved instance
+        :param update_fields: the names of the fields written by the save, all the fields if None
+        """
+        extractor = self.extractor
+        if update_fields is None:
+            current = extractor.record(instance)
+        elif self.current is _UNTRACKED or self.current is None:
+            return
+        else:
+            current = tuple(getattr(instance, attname) if name in update_fields or attname in update_fields else value
+                            for name, attname, value in zip(extractor.names, extractor.attnames, self.current))
+        # values computed by the database (e.g. `F('goals') + 1`) are unknown until read again
+        if any(hasattr(value, 'resolve_expression') for value in current):
+            current = _UNTRACKED
+        self.current = current
+
+    def deleted(self):
+        self.current = None
+
+    def untrack(self):
+        """forget the last known record, the instance has been written without signals"""
+        self.current = _UNTRACKED
+
+    def diff(self, current_record):
+        """:return the delta between the snapshot and `current_record`"""
+        if self.digest:
+            return self.extractor.digest_diff(self.record, current_record)
+        return self.extractor.diff(self.record, current_record)
 
     def assert_delta_is_equal_to(self, expected_delta_dict):
-        expected_delta = {(k, tuple(v)) if isinstance(v, list) else (k, v)
-                          for k, v in expected_delta_dict.items()}
-        current_instance = ModelInstanceObserved(self.model.objects.get(pk=self.pk))
-        # difference between two sets with - operator
-        delta = current_instance.field_set - self.field_set
-        assert delta == expected_delta
+        assert self.delta == expected_delta_dict
 
     @property
     def is_created(self):
@@ -43,12 +123,86 @@ class ModelInstanceObserved(object):
 
     @property
     def is_deleted(self):
-        try:
-            self.model.objects.get(pk=self.pk)
-        except self.model.DoesNotExist:
-            return True
-        else:
-            return False
+        return self.current_record() is None
+
+
+class QuerySetObserved(object):
+    """
+    Snapshot of the rows of a queryset, read by chunks in primary key order and kept as compact records.
+    The delta streams the queryset again and merges it with the snapshot, so the memory used is bounded
+    by the snapshot plus one chunk; the database and Python must order the primary keys the same way
+    (integers, UUIDs).
+    """
+    def __init__(self, queryset, extractor=None, chunk_size=2000, digest=False, cache=None):
+        """
+        :param extractor: the `FieldExtractor` of the fields to observe, all the concrete fields if not given
+        :param chunk_size: the number of rows read at a time
+        :param digest: if True, keep only the digests of the records, see `FieldExtractor.digest`
+        :param cache: a `SnapshotCache` providing the records of the unchanged rows, see `djmo.cache`
+        """
+        self.queryset = queryset
+        self.extractor = extractor or get_extractor(queryset.model)
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.cache = cache
+        self.pks = []
+        self.records = []
+        with sql.internal_queries():
+            for pk, record in self.rows():
+                self.pks.append(pk)
+                self.records.append(self.extractor.digest(record) if digest else record)
+
+    def rows(self):
+        """:return an iterator over `(pk, record)` of the rows of the queryset, as they are now, in pk order"""
+        if self.cache is not None:
+            return self.cache.rows(self.queryset, self.extractor, self.chunk_size)
+        return self._fetch_rows()
+
+    def _fetch_rows(self):
+        rows = self.queryset.order_by('pk').values_list('pk', *self.extractor.names)
+        # `chunk_size` is available since Django 2.0, before the rows are read by chunks of 100
+        rows = rows.iterator(chunk_size=self.chunk_size) if django.VERSION >= (2, 0) else rows.iterator()
+        previous_pk = None
+        for row in rows:
+            pk = row[0]
+            if previous_pk is not None and not previous_pk < pk:
+                raise ValueError("the primary keys of `{}` are not ordered the same way by the database "
+                                 "and by Python".format(self.queryset.model.__name__))
+            previous_pk = pk
+            yield pk, row[1:]
+
+    @property
+    def delta(self):
+        """:return the `QuerySetDelta` between the snapshot and the rows of the queryset as they are now"""
+        delta = QuerySetDelta()
+        pks, records = self.pks, self.records
+        diff = self.extractor.digest_diff if self.digest else self.extractor.diff
+        i, number_of_pks = 0, len(pks)
+        with sql.internal_queries():
+            for pk, record in self.rows():
+                while i < number_of_pks and pks[i] < pk:
+                    delta.deleted.append(pks[i])
+                    i += 1
+                if i < number_of_pks and pks[i] == pk:
+                    changes = diff(records[i], record)
+                    if changes:
+                        delta.updated[pk] = changes
+                    i += 1
+                else:
+                    delta.created.append(pk)
+        delta.deleted.extend(pks[i:])
+        return delta
+
+    def assert_delta_is_equal_to(self, created=(), updated=None, deleted=()):
+        """
+        :param created: the primary keys of the rows expected to be created
+        :param updated: the expected dictionary `pk -> {field name: new value}` of the updated rows
+        :param deleted: the primary keys of the rows expected to be deleted
+        """
+        delta = self.delta
+        assert set(delta.created) == set(created), "created rows: {}".format(delta.created)
+        assert delta.updated == (updated or {}), "updated rows: {}".format(delta.updated)
+        assert set(delta.deleted) == set(deleted), "deleted rows: {}".format(delta.deleted)
 
 
 class Observer(object):
@@ -56,45 +210,332 @@ class Observer(object):
     An observer observes the model given in init.
     It provides some properties and functions in order to know what's happening in the database.
     """
-    def __init__(self, model):
+    BACKENDS = ('signals', 'sql')
+
+    def __init__(self, model, batched=False, capture_bulk=False, backend='signals', record_queries=True, queries=None,
+                 threads=None, only=None, exclude=None, fingerprint=False, digest=False, transactional=False,
+                 profile=False, cache=None, max_workers=None, collector=None, incremental=False):
+        """
+        :param model: the model to be observed
+        :param batched: if True, observed instances are re-fetched all together with a single query,
+            memoized until the next write signal
+        :param capture_bulk: if True, also record as `batch_events` the bulk writes that do not send
+            signals (`bulk_create`, `QuerySet.update`, `bulk_update`, raw deletes)
+        :param backend: 'signals' to observe `post_save`/`post_delete`, 'sql' to observe the INSERT, UPDATE
+            and DELETE statements run on the table of the model, see `djmo.sql`
+        :param record_queries: if True, record the SQL statements run while the observer is connected
+        :param queries: the `QueryRecorder` to use, a new one if not given
+        :param threads: None to observe the writes of the context activating the observer (the current thread
+            or asyncio task), 'all' to observe the writes of every thread, 'current' to observe the writes of the
+            thread calling `connect`, or an iterable of `threading.Thread` objects and thread idents
+        :param only: the names of the fields to observe in the observed instances, all the concrete fields if not given
+        :param exclude: the names of the fields not to observe in the observed instances
+        :param fingerprint: if True, take a fingerprint of the whole table when the observer connects, so that
+            `nothing_has_changed` and `assertModelIsUntouched` also see the writes made by other processes,
+            see `djmo.fingerprint`; the checksum covers the observed fields, or the fields given as a list
+        :param digest: if True, observed instances and querysets keep a digest of their fields instead of
+            their values, see `FieldExtractor.digest`; deltas still report the new values, read from the database
+        :param transactional: if True, the saves and deletes made inside an atomic block are coalesced into one
+            net change per primary key, recorded when the block commits and thrown away when it rolls back,
+            see `djmo.transactions`; the blocks open when the observer connects are not taken into account
+        :param profile: True, or a sample rate between 0 and 1, to attribute the saves and deletes to the code
+            issuing them, see `djmo.profiling`; the report is printed when `observe` exits
+        :param cache: a `SnapshotCache` used by `observe_queryset` to read only the rows missing from it
+            or changed, see `djmo.cache`
+        :param max_workers: the number of threads re-fetching the observed instances of different databases
+            concurrently, one database after the other if not given; the threads use their own connections,
+            so they do not see the writes of the transaction of the current thread
+        :param collector: a started `Collector` merging the saves and deletes of the worker processes into the events
+            of the observer while it is connected, see `djmo.collector`
+        :param incremental: if True, the observed instances keep their last known record, updated from the saved
+            and deleted instances, so that `delta`, `is_updated` and `is_deleted` do not query the database;
+            the instances written without signals, observed before `connect` or after `disconnect`,
+            are re-fetched, see `verify` for the other writes
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("backend must be one of {}".format(", ".join(self.BACKENDS)))
+        if only is not None and exclude is not None:
+            raise ValueError("only one of `only` and `exclude` can be given")
         self.model = model
-        self.instances_created = []
-        self.instances_updated = []
-        self.instances_deleted = []
+        self.threads = threads
+        self._thread_objects = set()
+        self._thread_idents = set()
+        if threads not in (None, 'all', 'current'):
+            for thread in threads:
+                if isinstance(thread, threading.Thread):
+                    self._thread_objects.add(thread)
+                else:
+                    self._thread_idents.add(thread)
+        self.backend = backend
+        self.queries = (queries or sql.QueryRecorder()) if record_queries else None
+        self.batched = batched
+        self.digest = digest
+        self.transactional = transactional
+        self.cache = cache
+        self.max_workers = max_workers
+        self.collector = collector
+        self.connected = False
+        self.incremental = incremental
+        self.profiler = WriteProfiler(1.0 if profile is True else profile) if profile else None
+        # (thread ident, database alias, depth of the atomic block) -> TransactionBuffer
+        self._buffers = dict()
+        # database alias -> depth of the atomic blocks when the observer connected, in the connecting thread
+        self._baselines = dict()
+        self._connecting_thread = None
+        self.capture_bulk = capture_bulk
+        if exclude is not None:
+            excluded = set(exclude)
+            only = [field.name for field in FieldExtractor.concrete_fields(model)
+                    if field.name not in excluded and field.attname not in excluded]
+        self.extractor = get_extractor(model, only)
+        if fingerprint is True:
+            fingerprint = self.extractor.names
+        self.fingerprint_fields = tuple(fingerprint) if fingerprint else None
+        self.fingerprint = None
+        self.created = EventStore()
+        self.updated = EventStore()
+        self.deleted = EventStore()
+        # database alias -> {kind: EventStore} of the events on the database, see `events`
+        self.databases = dict()
+        self.batch_events = []
+        # (database alias, pk, relation name) -> RelationDelta
+        self.relations = dict()
+        # (database alias, pk) -> ModelInstanceObserved
         self.observed_instances = dict()
+        self._current_records = None
+
+    @property
+    def instances_created(self):
+        """the raw ordered list of primary keys of the created events"""
+        self.collect()
+        return self.created.log
+
+    @property
+    def instances_updated(self):
+        """the raw ordered list of primary keys of the updated events"""
+        self.collect()
+        return self.updated.log
+
+    @property
+    def instances_deleted(self):
+        """the raw ordered list of primary keys of the deleted events"""
+        self.collect()
+        return self.deleted.log
 
     @property
     def number_of_objects_created(self):
-        return len(set(self.instances_created))
+        self.collect()
+        return len(self.created)
 
     @property
     def number_of_objects_updated(self):
-        return len(set(self.instances_updated))
+        self.collect()
+        return len(self.updated)
 
     @property
     def number_of_objects_deleted(self):
-        return len(set(self.instances_deleted))
+        self.collect()
+        return len(self.deleted)
+
+    def events(self, using):
+        """
+        :param using: a database alias
+        :return a dictionary `kind -> EventStore` of the events on the database `using`
+        """
+        stores = self.databases.get(using)
+        if stores is None:
+            # `setdefault` is atomic: threads recording the first events on a database get the same stores
+            stores = self.databases.setdefault(using, {kind: EventStore() for kind in KINDS})
+        return stores
+
+    @property
+    def fingerprint_has_changed(self):
+        """
+        :return True if the table differs from its fingerprint, False if no fingerprint has been taken.
+            It runs one query.
+        """
+        if self.fingerprint is None:
+            return False
+        return table_fingerprint(self.model, self.fingerprint_fields) != self.fingerprint
 
     @property
     def nothing_has_changed(self):
-        return self.number_of_objects_created + \
-            self.number_of_objects_updated + \
-            self.number_of_objects_deleted == 0
+        self.collect()
+        return not (self.created or self.updated or self.deleted or self.fingerprint_has_changed)
 
     def reset(self):
         """reset all internal counters"""
-        self.instances_created = []
-        self.instances_updated = []
-        self.instances_deleted = []
-
-    def observe_instance(self, instance):
-        if self.model is not type(instance):
+        self.collect()
+        self.created.clear()
+        self.updated.clear()
+        self.deleted.clear()
+        self.databases = dict()
+        self.batch_events = []
+        self.relations = dict()
+        self._buffers = dict()
+        if self.profiler is not None:
+            self.profiler.reset()
+        if self.queries is not None:
+            self.queries.reset()
+        if self.fingerprint is not None:
+            self.fingerprint = table_fingerprint(self.model, self.fingerprint_fields)
+
+    def observe_instance(self, instance, fields=None, follow=None):
+        """
+        :param fields: the names of the fields to observe, the fields of the observer if not given
+        :param follow: the names of the relations whose objects are observed too (e.g. `['soccerplayer_set']`),
+            with one query per relation, see `graph_delta`
+        """
+        if self.model is not model_of(instance):
             raise ValueError("instance must be an instance of `{}`".format(self.model))
-        self.observed_instances[instance.pk] = ModelInstanceObserved(instance)
-
-    def observe_instances(self, *instances):
+        extractor = get_extractor(self.model, fields) if fields is not None else self.extractor
+        # the writes are received only while the observer is connected: before, the instance is re-fetched
+        observed = ModelInstanceObserved(instance, self, extractor, self.digest, self.incremental and self.connected)
+        self.observed_instances[(observed.using, observed.pk)] = observed
+        self._current_records = None
+        if follow:
+            self._follow([observed], follow)
+
+    def observe_instances(self, *instances, follow=None):
+        """
+        :param follow: the names of the relations whose objects are observed too,
+            with one query per relation for all the instances
+        """
         for instance in instances:
             self.observe_instance(instance)
+        if follow:
+            self._follow([self._observed(instance) for instance in instances], follow)
+
+    def _follow(self, observed_instances, follow):
+        for name in follow:
+            relation = get_relation(self.model, name)
+            snapshots = self._fetch_by_database(relation.fetch, observed_instances)
+            for observed in observed_instances:
+                records = snapshots[observed.using][observed.pk]
+                if self.digest:
+                    records = {pk: relation.extractor.digest(record) for pk, record in records.items()}
+                observed.related[relation] = records
+
+    def graph_delta(self, instance=None):
+        """
+        Re-fetch the observed instances and the objects of their followed relations,
+        with one query per database and subset of fields and one per database and relation.
+        :param instance: an observed instance, all the observed instances if not given
+        :return the `GraphDelta` of `instance`, or a dictionary `(database alias, pk) -> GraphDelta`
+            of all the observed instances
+        """
+        if instance is None:
+            observed_instances = list(self.observed_instances.values())
+        else:
+            observed_instances = [self._observed(instance)]
+        current_records = dict()
+        for extractor in {observed.extractor for observed in observed_instances}:
+            current_records[extractor] = self._fetch_by_database(
+                extractor.fetch, [observed for observed in observed_instances if observed.extractor is extractor])
+        current_related = dict()
+        for relation in {relation for observed in observed_instances for relation in observed.related}:
+            current_related[relation] = self._fetch_by_database(
+                relation.fetch, [observed for observed in observed_instances if relation in observed.related])
+        deltas = dict()
+        for observed in observed_instances:
+            delta = deltas[(observed.using, observed.pk)] = GraphDelta()
+            current_record = current_records[observed.extractor][observed.using].get(observed.pk)
+            if current_record is None:
+                delta.deleted = True
+            else:
+                delta.fields = observed.diff(current_record)
+            for relation, records in observed.related.items():
+                diff = relation.extractor.digest_diff if observed.digest else relation.extractor.diff
+                delta.related[relation.name] = QuerySetDelta.between(
+                    records, current_related[relation][observed.using][observed.pk], diff)
+        return deltas.popitem()[1] if instance is not None else deltas
+
+    def observe_queryset(self, queryset, fields=None, chunk_size=2000):
+        """
+        Snapshot the rows of `queryset` without building model instances, for large tables.
+        :param fields: the names of the fields to observe, the fields of the observer if not given
+        :param chunk_size: the number of rows read at a time
+        :return the `QuerySetObserved`, its `delta` streams the queryset again
+        """
+        if self.model is not queryset.model:
+            raise ValueError("queryset must be a queryset of `{}`".format(self.model))
+        if queryset.query.low_mark or queryset.query.high_mark is not None:
+            raise ValueError("queryset must not be sliced: its rows are read in primary key order, "
+                             "filter it on the primary keys instead")
+        extractor = get_extractor(self.model, fields) if fields is not None else self.extractor
+        return QuerySetObserved(queryset, extractor, chunk_size, self.digest, self.cache)
+
+    def current_records(self, extractor=None, using=None):
+        """
+        Fetch all observed instances with one query per database and observed subset of fields.
+        While the observer is connected the result is memoized until the next write signal it receives.
+        :param extractor: the `FieldExtractor` of the subset of fields, the one of the observer if not given
+        :param using: the database alias of the instances, the default database if not given
+        :return a dictionary `pk -> record` of the observed instances of the database still in it
+        """
+        extractor = extractor or self.extractor
+        if self._current_records is None or not self.connected:
+            # the writes made while the observer is not connected are not received: nothing is memoized
+            self._current_records = dict()
+        if extractor not in self._current_records:
+            self._current_records[extractor] = self._fetch_by_database(
+                extractor.fetch,
+                [observed for observed in self.observed_instances.values() if observed.extractor is extractor])
+        return self._current_records[extractor].get(using or DEFAULT_DB_ALIAS, {})
+
+    def verify(self, instance=None):
+        """
+        Check the last known records of an incremental observer against the database, with one query
+        per database and subset of fields; the records found different are replaced by the ones read.
+        They can differ after writes made without signals (raw SQL, other processes), rolled back writes
+        or values normalized by the database (e.g. a string saved in a `DateField`).
+        :param instance: an observed instance, all the observed instances if not given
+        :return a dictionary `(database alias, pk) -> {field name: value in the database}` of the differences,
+            with None as value when the instance exists only in the database or only in memory
+        """
+        if not self.incremental:
+            raise ValueError("only the records of an incremental observer can be verified")
+        if instance is None:
+            observed_instances = list(self.observed_instances.values())
+        else:
+            observed_instances = [self._observed(instance)]
+        differences = dict()
+        for extractor in {observed.extractor for observed in observed_instances}:
+            records = self._fetch_by_database(
+                extractor.fetch, [observed for observed in observed_instances if observed.extractor is extractor])
+            for observed in observed_instances:
+                if observed.extractor is not extractor:
+                    continue
+                record = records[observed.using or DEFAULT_DB_ALIAS].get(observed.pk)
+                if not observed.is_tracked:
+                    if self.connected:
+                        observed.current = record
+                elif record is None or observed.current is None:
+                    if record is not observed.current:
+                        differences[(observed.using, observed.pk)] = None
+                        observed.current = record
+                else:
+                    difference = extractor.diff(observed.current, record)
+                    if difference:
+                        differences[(observed.using, observed.pk)] = difference
+                        observed.current = record
+        return differences
+
+    def _fetch_by_database(self, fetch, observed_instances):
+        """
+        Call `fetch(pks, using)` once per database of the observed instances,
+        concurrently if the observer has `max_workers` and the instances come from several databases.
+        :return a dictionary `database alias -> result of fetch`
+        """
+        pks = dict()
+        for observed in observed_instances:
+            pks.setdefault(observed.using or DEFAULT_DB_ALIAS, []).append(observed.pk)
+        if self.max_workers is None or len(pks) < 2:
+            return {using: fetch(database_pks, using) for using, database_pks in pks.items()}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pks))) as executor:
+            futures = {using: executor.submit(_fetch_in_thread, fetch, database_pks, using)
+                       for using, database_pks in pks.items()}
+            return {using: future.result() for using, future in futures.items()}
 
     def monkey_patch_observer(self, test):
         """
@@ -110,49 +551,277 @@ class Observer(object):
             an instance of ModelInstancePatched if `inst` is NOT observed
         """
         instance_pk = inst.pk or getattr(inst, '_old_id', None)
-        if instance_pk not in self.observed_instances:
+        using = inst._state.db
+        if (using, instance_pk) not in self.observed_instances:
+            if using is not None and self.databases:
+                events = self.events(using)
+            else:
+                events = {kind: getattr(self, kind) for kind in KINDS}
             return ModelInstancePatched(instance_pk=instance_pk,
-                                        is_created=instance_pk in self.instances_created,
-                                        is_updated=instance_pk in self.instances_updated,
-                                        is_deleted=instance_pk in self.instances_deleted)
+                                        is_created=instance_pk in events['created'],
+                                        is_updated=instance_pk in events['updated'],
+                                        is_deleted=instance_pk in events['deleted'])
         else:
-            return self.observed_instances[instance_pk]
+            return self.observed_instances[(using, instance_pk)]
+
+    def _observed(self, instance):
+        """:return the `ModelInstanceObserved` of `instance`"""
+        if self.model is not model_of(instance):
+            raise ValueError("instance must be an instance of `{}`".format(self.model))
+        try:
+            return self.observed_instances[(instance._state.db, instance.pk)]
+        except KeyError:
+            raise ValueError('instance must be an observed instance')
+
+    def observes_current_thread(self):
+        """:return True if the writes made by the current thread are observed, see the `threads` option"""
+        if self.threads == 'all':
+            return True
+        return threading.get_ident() in self._thread_idents or threading.current_thread() in self._thread_objects
 
     def connect(self):
-        """connect Django signals"""
-        post_save.connect(self.save_receiver, self.model, dispatch_uid="observe_post_save_model_{}".format(self.model.__name__))
-        post_delete.connect(self.delete_receiver, self.model, dispatch_uid="observe_post_delete_model_{}".format(self.model.__name__))
+        """start observing: activate the observer in the current context, see `djmo.dispatch`"""
+        if self.threads == 'current':
+            self._thread_idents = {threading.get_ident()}
+        if self.fingerprint_fields is not None:
+            self.fingerprint = table_fingerprint(self.model, self.fingerprint_fields)
+        if self.queries is not None:
+            self.queries.start()
+        self._current_records = None
+        self.connected = True
+        dispatch.activate(self)
+        if self.backend == 'sql':
+            sql.capture(self)
+        if self.capture_bulk:
+            bulk.capture(self)
+        if self.collector is not None:
+            self.collector.register(self)
+        if self.transactional:
+            self._connecting_thread = threading.get_ident()
+            self._baselines = {connection.alias: transactions.depth(connection) for connection in connections.all()}
+            transactions.capture(self)
 
     def disconnect(self):
-        """disconnect Django signals"""
-        post_save.disconnect(self.save_receiver, self.model, dispatch_uid="observe_post_save_model_{}".format(self.model.__name__))
-        post_delete.disconnect(self.delete_receiver, self.model, dispatch_uid="observe_post_delete_model_{}".format(self.model.__name__))
+        """stop observing"""
+        if self.queries is not None:
+            self.queries.stop()
+        dispatch.deactivate(self)
+        self.connected = False
+        self._current_records = None
+        # the next writes are not received, the last known records would become stale
+        self._untrack(None)
+        if self.backend == 'sql':
+            sql.release(self)
+        if self.capture_bulk:
+            bulk.release(self)
+        if self.collector is not None:
+            # lost events are reported by the counters, disconnecting must not fail
+            self.collector.drain(check=False)
+            self.collector.unregister(self)
+        if self.transactional:
+            transactions.release(self)
+            # the blocks still open have not been committed yet, their events are recorded anyway
+            for key in sorted(self._buffers, key=lambda key: key[2], reverse=True):
+                self._apply(self._buffers.pop(key), key[1])
 
     def save_receiver(self, sender, instance=None, created=False, **kwargs):
         """receiver for save and update signals"""
-        if created:
-            self.instances_created.append(instance.pk)
-        else:
-            self.instances_updated.append(instance.pk)
+        self._current_records = None
+        self._event('created' if created else 'updated', instance.pk, kwargs.get('using'))
+        if self.incremental:
+            observed = self.observed_instances.get((kwargs.get('using'), instance.pk))
+            if observed is not None:
+                observed.saved(instance, kwargs.get('update_fields'))
 
     def delete_receiver(self, sender, instance=None, **kwargs):
         """receiver for delete signal"""
-        self.instances_deleted.append(instance.pk)
+        self._current_records = None
+        self._event('deleted', instance.pk, kwargs.get('using'))
+        if self.incremental:
+            observed = self.observed_instances.get((kwargs.get('using'), instance.pk))
+            if observed is not None:
+                observed.deleted()
         instance._old_id = instance.pk
 
-    def assertDelta(self, instance, delta):
+    def _untrack(self, using, pks=None):
+        """
+        forget the last known records of the observed instances written without signals
+        :param pks: the primary keys written, all the instances of the database if None
+        """
+        if not self.incremental:
+            return
+        pks = set(pks) if pks is not None else None
+        for (alias, pk), observed in self.observed_instances.items():
+            if (using is None or alias == using) and (pks is None or pk in pks):
+                observed.untrack()
+
+    def _event(self, kind, pk, using):
+        if self.profiler is None:
+            self._add_event(kind, pk, using)
+            return
+        start = time.perf_counter()
+        self._add_event(kind, pk, using)
+        self.profiler.record(kind, time.perf_counter() - start)
+
+    def _add_event(self, kind, pk, using):
+        """record an event, or buffer it in the innermost atomic block if the observer is transactional"""
+        if self.transactional:
+            connection = connections[using or 'default']
+            depth = transactions.depth(connection)
+            if depth > self._baseline(connection.alias):
+                key = (threading.get_ident(), connection.alias, depth)
+                buffer = self._buffers.get(key)
+                if buffer is None:
+                    buffer = self._buffers[key] = transactions.TransactionBuffer()
+                buffer.add(kind, pk)
+                return
+        self._store(kind, pk, using)
+
+    def _store(self, kind, pk, using):
+        getattr(self, kind).add(pk)
+        if using is not None:
+            self.events(using)[kind].add(pk)
+
+    def _baseline(self, alias):
+        if threading.get_ident() != self._connecting_thread:
+            return 0
+        return self._baselines.get(alias, 0)
+
+    def _apply(self, buffer, using):
+        for kind, pk in buffer:
+            self._store(kind, pk, using)
+
+    def atomic_exit(self, alias, depth, committed):
+        """
+        receiver for the exits of the atomic blocks, see `djmo.transactions`
+        :param depth: the depth of the block, 1 for the outermost one
+        :param committed: False if the block has been rolled back
+        """
+        buffer = self._buffers.pop((threading.get_ident(), alias, depth), None)
+        if buffer is not None and not committed:
+            self._untrack(alias, [pk for _, pk in buffer])
+        if buffer is None or not committed:
+            return
+        if depth - 1 <= self._baseline(alias):
+            self._apply(buffer, alias)
+            return
+        key = (threading.get_ident(), alias, depth - 1)
+        if key in self._buffers:
+            self._buffers[key].merge(buffer)
+        else:
+            self._buffers[key] = buffer
+
+    def m2m_receiver(self, pk, relation, change, pk_set, using=None):
+        """
+        receiver for the changes of the many-to-many relations, see `djmo.dispatch`
+        :param pk: the primary key of the instance whose relation changed
+        :param relation: the name of the relation on the observed model
+        :param change: 'add', 'remove' or 'clear'
+        :param pk_set: the primary keys of the related objects added or removed, None for a clear
+        :param using: the alias of the database written
+        """
+        delta = self.relations.get((using, pk, relation))
+        if delta is None:
+            delta = self.relations.setdefault((using, pk, relation), RelationDelta())
+        if change == 'add':
+            delta.add(pk_set)
+        elif change == 'remove':
+            delta.remove(pk_set)
+        else:
+            delta.clear()
+
+    def relation_delta(self, instance, relation):
+        """
+        :param relation: the name of a many-to-many relation of the observed model, reverse accessors included
+        :return the `RelationDelta` of the relation of `instance` since the beginning of the observation
+        """
+        return self.relations.get((instance._state.db, instance.pk, relation)) or RelationDelta()
+
+    def batch_receiver(self, kind, pks, count, filter=None, using=None):
+        """
+        receiver for bulk writes, see `djmo.bulk`
+        :param kind: 'created', 'updated' or 'deleted'
+        :param pks: the primary keys found for the affected rows
+        :param count: the number of affected rows
+        :param filter: the SQL of the queryset when the primary keys are unknown
+        :param using: the alias of the database written
+        """
+        self._record(kind, pks, count, using)
+        self.batch_events.append(BatchEvent(kind, pks, count, filter))
+
+    def sql_receiver(self, kind, pks, count, using=None):
+        """
+        receiver for the statements captured by the 'sql' backend, see `djmo.sql`
+        :param kind: 'created', 'updated' or 'deleted'
+        :param pks: the primary keys found for the affected rows
+        :param count: the number of affected rows
+        :param using: the alias of the database written
+        """
+        self._record(kind, pks, count, using)
+
+    def collector_receiver(self, kind, pk, using=None):
+        """receiver for the saves and deletes of the worker processes, see `djmo.collector`"""
+        self._current_records = None
+        self._untrack(using, [pk])
+        self._store(kind, pk, using)
+
+    def collect(self):
+        """
+        wait until the events sent by the worker processes so far are merged, if a collector is set
+        :raise `djmo.collector.EventsLost` if some of them have been lost
+        """
+        if self.collector is not None:
+            self.collector.drain()
+
+    def _record(self, kind, pks, count, using=None):
+        self._current_records = None
+        if count < len(pks):
+            # fewer rows than primary keys: which ones have been written is unknown
+            pks = []
+        self._untrack(using, pks if count <= len(pks) else None)
+        stores = [getattr(self, kind)]
+        if using is not None:
+            stores.append(self.events(using)[kind])
+        for events in stores:
+            for pk in pks:
+                events.add(pk)
+            if count > len(pks):
+                events.add_anonymous(count - len(pks))
+
+    def assertDelta(self, instance, delta, verify=False):
+        """:param verify: if True, check first the last known record of an incremental observer, see `verify`"""
         # TODO better logging in case of failure
-        if self.model is not type(instance):
-            raise ValueError("instance must be an instance of `{}`".format(self.model))
-        if instance.pk not in self.observed_instances:
-            raise ValueError('instance must be an observed instance')
-        self.observed_instances[instance.pk].assert_delta_is_equal_to(delta)
+        if verify:
+            differences = self.verify(instance)
+            assert not differences, "the last known record differs from the database: {}".format(differences)
+        self._observed(instance).assert_delta_is_equal_to(delta)
 
     def assertModelIsUntouched(self):
         # TODO better logging in case of failure
         assert self.number_of_objects_created == 0
         assert self.number_of_objects_updated == 0
         assert self.number_of_objects_deleted == 0
+        assert not self.fingerprint_has_changed, \
+            "the table `{}` has been written by another process".format(self.model._meta.db_table)
+
+    def _recorded_queries(self):
+        if self.queries is None:
+            raise ValueError("the queries of the observer of `{}` are not recorded, "
+                             "create it with `record_queries=True`".format(self.model.__name__))
+        return self.queries
+
+    def assertMaxQueries(self, number_of_queries):
+        """check that at most `number_of_queries` statements ran on the table of the model"""
+        count = self._recorded_queries().count_by_table[self.model._meta.db_table]
+        assert count <= number_of_queries, \
+            "{} queries on `{}`, expected at most {}".format(count, self.model._meta.db_table, number_of_queries)
+
+    def assertQueryTimeBelow(self, milliseconds):
+        """check that the statements on the table of the model took less than `milliseconds` in total"""
+        elapsed = self._recorded_queries().time_by_table[self.model._meta.db_table] * 1000
+        assert elapsed < milliseconds, \
+            "queries on `{}` took {:.3f} ms, expected less than {} ms".format(
+                self.model._meta.db_table, elapsed, milliseconds)
 
 
 class ObserversList():
@@ -160,6 +829,7 @@ class ObserversList():
 
     def __init__(self):
         self._observers = dict()
+        self.queries = sql.QueryRecorder()
 
     def __getitem__(self, key):
         return self._observers[key]
@@ -178,6 +848,16 @@ class ObserversList():
         for observer in self._observers.values():
             observer.reset()
 
+    def assertMaxQueries(self, model, number_of_queries):
+        """check that at most `number_of_queries` statements ran on the table of `model`"""
+        self._observers[model].assertMaxQueries(number_of_queries)
+
+    def assertQueryTimeBelow(self, milliseconds):
+        """check that all the statements took less than `milliseconds` in total"""
+        elapsed = self.queries.time * 1000
+        assert elapsed < milliseconds, \
+            "{} queries took {:.3f} ms, expected less than {} ms".format(self.queries.count, elapsed, milliseconds)
+
     @property
     def nothing_has_changed(self):
         """
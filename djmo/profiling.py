@@ -0,0 +1,89 @@
+"""
+Attribution of the writes of an observed model to the code issuing them.
+For each sampled write signal the profiler walks up the stack to the first frame outside of Django and djmo
+(the call site) and aggregates per call site the number of writes of each kind and the time spent
+in the receiver of the observer.
+"""
+import os
+import random
+import sys
+from collections import Counter, defaultdict
+
+import django
+
+from .events import KINDS
+
+_random = random.random
+_DJANGO_DIR = os.path.dirname(os.path.abspath(django.__file__)) + os.sep
+_DJMO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _is_internal(filename):
+    """:return True for the modules of Django and of djmo, the tests of djmo excluded"""
+    filename = os.path.abspath(filename)
+    return filename.startswith(_DJANGO_DIR) or os.path.dirname(filename) == _DJMO_DIR
+
+
+class WriteProfiler(object):
+    """
+    Counts of the writes and time of the receiver per call site.
+    With a sample rate below 1 only a fraction of the writes are attributed (the stack walk is the costly part),
+    the counts of the report are scaled by it.
+    """
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.writes = 0
+        # call site -> Counter of the kinds of writes
+        self.counts = defaultdict(Counter)
+        # call site -> seconds spent in the receiver
+        self.time = defaultdict(float)
+        # filenames already classified, the stack walk runs for every sampled write
+        self._internal = dict()
+
+    def record(self, kind, elapsed):
+        """
+        :param kind: 'created', 'updated' or 'deleted'
+        :param elapsed: the seconds spent in the receiver of the observer
+        """
+        self.writes += 1
+        if self.sample_rate < 1 and _random() >= self.sample_rate:
+            return
+        site = self._call_site()
+        self.counts[site][kind] += 1
+        self.time[site] += elapsed
+
+    def _call_site(self):
+        frame = sys._getframe(2)
+        internal = self._internal
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename not in internal:
+                internal[filename] = _is_internal(filename)
+            if not internal[filename]:
+                return filename, frame.f_lineno, frame.f_code.co_name
+            frame = frame.f_back
+        return ('<unknown>', 0, '<unknown>')
+
+    def reset(self):
+        self.writes = 0
+        self.counts.clear()
+        self.time.clear()
+
+    def ranked(self):
+        """
+        :return a list of `(call site, estimated counts by kind, seconds in the receiver)`,
+            the call site with more writes first
+        """
+        scale = 1 / self.sample_rate if self.sample_rate else 0
+        sites = sorted(self.counts, key=lambda site: sum(self.counts[site].values()), reverse=True)
+        return [(site, {kind: int(round(self.counts[site][kind] * scale)) for kind in KINDS}, self.time[site] * scale)
+                for site in sites]
+
+    def report(self, title, limit=20):
+        """:return the ranked call sites as text, at most `limit` of them"""
+        lines = ["{}: {} writes, {:.0%} sampled".format(title, self.writes, self.sample_rate),
+                 "{:>8} {:>8} {:>8} {:>12}  call site".format('created', 'updated', 'deleted', 'receiver ms')]
+        for (filename, line, function), counts, seconds in self.ranked()[:limit]:
+            lines.append("{:>8} {:>8} {:>8} {:>12.3f}  {}:{} in {}".format(
+                counts['created'], counts['updated'], counts['deleted'], seconds * 1000, filename, line, function))
+        return "\n".join(lines)
@@ -0,0 +1,202 @@
+import struct
+from operator import attrgetter
+
+from django.db import connections
+
+from .sql import internal_queries
+
+# digests are 64 bits
+_MASK = (1 << 64) - 1
+
+
+class FieldExtractor(object):
+    """
+    Precompiled reader of the concrete fields (primary key excluded) of a model.
+    A record is a tuple with the values of the fields in the order given by `names`,
+    so two records of the same model are compared position by position.
+    Use `get_extractor` to obtain the extractor of a model, it is built once per model class and subset of fields.
+    """
+    def __init__(self, model, fields=None):
+        """
+        :param fields: names (or attnames) of the fields to read, all the concrete fields if not given
+        """
+        fields = self.concrete_fields(model, fields)
+        self.model = model
+        self.names = tuple(field.name for field in fields)
+        self.attnames = tuple(field.attname for field in fields)
+        if len(self.attnames) > 1:
+            self.record = attrgetter(*self.attnames)
+        else:
+            # attrgetter returns a single value instead of a tuple when it gets less than two names
+            getters = [attrgetter(attname) for attname in self.attnames]
+            self.record = lambda instance: tuple(getter(instance) for getter in getters)
+        self._digests = struct.Struct('<{}Q'.format(len(self.names)))
+
+    @staticmethod
+    def concrete_fields(model, names=None):
+        """:return the concrete fields of `model` (primary key excluded), only the given ones if `names` is given"""
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        if names is None:
+            return fields
+        fields_by_name = {}
+        for field in fields:
+            fields_by_name[field.name] = fields_by_name[field.attname] = field
+        unknown = [name for name in names if name not in fields_by_name]
+        if unknown:
+            raise ValueError("unknown fields of `{}`: {}".format(model.__name__, ", ".join(unknown)))
+        return [fields_by_name[name] for name in names]
+
+    def fetch(self, pks, using=None):
+        """
+        Read the records of the given primary keys with one query (per batch of primary keys on SQLite),
+        without building model instances and loading only the columns of the extractor.
+        :param using: the alias of the database, the database for reads of the model if not given
+        :return a dictionary `pk -> record` of the rows still in the database
+        """
+        pks = list(pks)
+        queryset = self.model._default_manager.using(using) if using else self.model._default_manager.all()
+        # one query per batch of primary keys on the databases limiting the number of parameters (SQLite)
+        batch_size = _max_query_params(connections[queryset.db]) or len(pks) or 1
+        records = dict()
+        with internal_queries():
+            for start in range(0, len(pks), batch_size):
+                rows = queryset.filter(pk__in=pks[start:start + batch_size]).values_list('pk', *self.names)
+                records.update((row[0], row[1:]) for row in rows)
+        return records
+
+    def diff(self, old_record, new_record):
+        """
+        :return a dictionary `field name -> new value` of the fields that differ between the two records
+        """
+        if old_record == new_record:
+            return {}
+        names = self.names
+        return {names[i]: new_value
+                for i, (old_value, new_value) in enumerate(zip(old_record, new_record))
+                if old_value != new_value}
+
+    def digest(self, record):
+        """
+        :return the compact digest of a record: the 64-bit hashes of its values packed in a bytes object,
+            valid only in the current process (strings are hashed with the randomized `hash`)
+        """
+        return self._digests.pack(*map(digest_value, record))
+
+    def digest_diff(self, old_digest, new_record):
+        """
+        :return a dictionary `field name -> new value` of the fields whose digest differs
+            between `old_digest` and the digest of `new_record`
+        """
+        new_digest = self.digest(new_record)
+        if old_digest == new_digest:
+            return {}
+        names = self.names
+        return {names[i]: new_record[i]
+                for i, (old_hash, new_hash) in enumerate(zip(self._digests.unpack(old_digest),
+                                                             self._digests.unpack(new_digest)))
+                if old_hash != new_hash}
+
+
+def digest_value(value):
+    """:return the 64-bit hash of a value, the value itself for the integers (`hash(-1) == hash(-2)`)"""
+    if isinstance(value, int):
+        return value & _MASK
+    try:
+        return hash(value) & _MASK
+    except TypeError:
+        # unhashable values, e.g. the lists and dictionaries of JSON and array fields
+        return hash(repr(value)) & _MASK
+
+
+def _max_query_params(connection):
+    """:return the maximum number of parameters of a query, None if unlimited"""
+    # `max_query_params` is available since Django 2.0, before only SQLite has a limit
+    default = 999 if connection.vendor == 'sqlite' else None
+    return getattr(connection.features, 'max_query_params', default)
+
+
+_extractors = dict()
+
+
+def get_extractor(model, fields=None):
+    """
+    :param fields: names of the fields to read, all the concrete fields if not given
+    :return the `FieldExtractor` of `model`, building it the first time
+    """
+    key = (model, tuple(fields) if fields is not None else None)
+    try:
+        return _extractors[key]
+    except KeyError:
+        extractor = _extractors[key] = FieldExtractor(model, fields)
+        return extractor
+
+
+class RelationExtractor(object):
+    """
+    Reader of the records of the objects related to a set of instances through one relation
+    (forward or reverse foreign key, one-to-one or many-to-many), with one query joining the relation.
+    Use `get_relation` to obtain the extractor of a relation.
+    """
+    def __init__(self, model, name):
+        """
+        :param name: the name of the relation: the name of the field, or the accessor of a reverse relation
+            (e.g. `soccerplayer_set`)
+        """
+        self.model = model
+        self.name = name
+        field = self._relation(model, name)
+        # the name of the relation in the lookups
+        self.path = field.name
+        self.extractor = get_extractor(field.related_model)
+        self.lookups = ['pk', '{}__pk'.format(self.path)] + ['{}__{}'.format(self.path, name)
+                                                             for name in self.extractor.names]
+
+    @staticmethod
+    def _relation(model, name):
+        for field in model._meta.get_fields():
+            if not field.is_relation or getattr(field, 'related_model', None) is None:
+                continue
+            accessor = field.get_accessor_name() if hasattr(field, 'get_accessor_name') else field.name
+            if name in (field.name, accessor):
+                return field
+        raise ValueError("unknown relation of `{}`: {}".format(model.__name__, name))
+
+    def fetch(self, pks, using=None):
+        """
+        :param pks: the primary keys of instances of the model
+        :param using: the alias of the database, the database for reads of the model if not given
+        :return a dictionary `pk -> {related pk: record}` of the related objects of the given instances
+        """
+        pks = list(pks)
+        queryset = self.model._default_manager.using(using) if using else self.model._default_manager.all()
+        batch_size = _max_query_params(connections[queryset.db]) or len(pks) or 1
+        related = {pk: dict() for pk in pks}
+        with internal_queries():
+            for start in range(0, len(pks), batch_size):
+                rows = queryset.filter(pk__in=pks[start:start + batch_size]).values_list(*self.lookups)
+                for row in rows:
+                    # no related object, with the outer join
+                    if row[1] is not None:
+                        related[row[0]][row[1]] = row[2:]
+        return related
+
+
+_relations = dict()
+
+
+def get_relation(model, name):
+    """:return the `RelationExtractor` of the relation `name` of `model`, building it the first time"""
+    key = (model, name)
+    try:
+        return _relations[key]
+    except KeyError:
+        relation = _relations[key] = RelationExtractor(model, name)
+        return relation
+
+
+def model_of(instance):
+    """:return the model of `instance`, also for the deferred instances of Django < 1.10 (`.only()`, `.defer()`)"""
+    model = type(instance)
+    if getattr(instance, '_deferred', False):
+        model = model._meta.proxy_for_model
+    return model
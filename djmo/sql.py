@@ -0,0 +1,227 @@
+"""
+SQL-level change capture and query recording.
+A single execute wrapper on the database connections classifies the INSERT, UPDATE and DELETE statements
+per table and feeds the observers of the models stored in those tables.
+It sees every write (raw SQL, `QuerySet.update`, `bulk_create`, `bulk_update`...), not only the ones
+sending signals.
+Django >= 2.0 provides `connection.execute_wrappers`, older versions get the same mechanism
+through a cursor wrapper installed on the connection.
+`QueryRecorder` uses the same mechanism to record the cost of the statements,
+the statements run by djmo itself inside `internal_queries` are not recorded.
+"""
+import functools
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends import utils
+
+from . import dispatch
+
+_WRITE_STATEMENT = re.compile(r'^\s*(INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+[`"\[]?([^\s`"\]\(]+)', re.IGNORECASE)
+_KINDS = {'INSERT': 'created', 'UPDATE': 'updated', 'DELETE': 'deleted'}
+_TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+[`"\[]?([^\s`"\]\(,]+)', re.IGNORECASE)
+# WHERE clause filtering only on primary keys, e.g. `WHERE "soccer_soccerplayer"."id" IN (%s, %s)`
+_PK_FILTER = r'\sWHERE\s+(?:[`"\[]?\w+[`"\]]?\.)?[`"\[]?{}[`"\]]?\s*(?:=\s*%s|IN\s*\(((?:%s\s*,\s*)*%s)\))\s*$'
+
+# db table -> list of observers of the model stored in the table
+_observers = dict()
+_lock = threading.Lock()
+
+
+class _Internal(threading.local):
+    """the number of nested `internal_queries` blocks of the current thread"""
+    depth = 0
+
+
+_internal = _Internal()
+
+
+@contextmanager
+def internal_queries():
+    """run the statements of djmo (re-fetches, fingerprints, snapshots) without recording them"""
+    _internal.depth += 1
+    try:
+        yield
+    finally:
+        _internal.depth -= 1
+
+
+class _ExecuteWrappersMixin(object):
+    """`execute_wrappers` support for the cursors of Django < 2.0, it mirrors the implementation of Django 2.0"""
+
+    def execute(self, sql, params=None):
+        execute = super(_ExecuteWrappersMixin, self).execute
+        return self._execute_with_wrappers(sql, params, False,
+                                           lambda sql, params, many, context: execute(sql, params))
+
+    def executemany(self, sql, param_list):
+        executemany = super(_ExecuteWrappersMixin, self).executemany
+        return self._execute_with_wrappers(sql, param_list, True,
+                                           lambda sql, param_list, many, context: executemany(sql, param_list))
+
+    def _execute_with_wrappers(self, sql, params, many, executor):
+        context = {'connection': self.db, 'cursor': self}
+        for wrapper in reversed(self.db.execute_wrappers):
+            executor = functools.partial(wrapper, executor)
+        return executor(sql, params, many, context)
+
+
+class _CursorWrapper(_ExecuteWrappersMixin, utils.CursorWrapper):
+    pass
+
+
+class _CursorDebugWrapper(_ExecuteWrappersMixin, utils.CursorDebugWrapper):
+    pass
+
+
+def add_execute_wrapper(connection, wrapper):
+    """
+    Add `wrapper` to the execute wrappers of `connection`, until `remove_execute_wrapper` is called.
+    A wrapper is called as `wrapper(execute, sql, params, many, context)`, see `connection.execute_wrapper`
+    """
+    if not hasattr(connection, 'execute_wrappers'):
+        connection.execute_wrappers = []
+        connection.make_cursor = lambda cursor: _CursorWrapper(cursor, connection)
+        connection.make_debug_cursor = lambda cursor: _CursorDebugWrapper(cursor, connection)
+    connection.execute_wrappers.append(wrapper)
+
+
+def remove_execute_wrapper(connection, wrapper):
+    execute_wrappers = getattr(connection, 'execute_wrappers', [])
+    if wrapper in execute_wrappers:
+        execute_wrappers.remove(wrapper)
+
+
+def referenced_tables(sql):
+    """:return the set of the tables read or written by a statement"""
+    return set(_TABLE_REFERENCE.findall(sql))
+
+
+def parse_write(sql):
+    """
+    :return `(kind, table)` of an INSERT, UPDATE or DELETE statement, None for any other statement
+    """
+    match = _WRITE_STATEMENT.match(sql)
+    if match is None:
+        return None
+    return _KINDS[match.group(1).split()[0].upper()], match.group(2)
+
+
+def filtered_pks(sql, params, pk_column):
+    """
+    :return the primary keys of an UPDATE or DELETE statement filtering only on `pk_column`, None otherwise
+    """
+    match = re.search(_PK_FILTER.format(re.escape(pk_column)), sql, re.IGNORECASE)
+    if match is None or not params:
+        return None
+    number_of_pks = match.group(1).count('%s') if match.group(1) else 1
+    return list(params[-number_of_pks:])
+
+
+def capture_writes(execute, sql, params, many, context):
+    """execute wrapper feeding the observers of the written tables"""
+    result = execute(sql, params, many, context)
+    write = parse_write(sql)
+    captured = _observers.get(write[1]) if write is not None else None
+    if not captured:
+        return result
+    model = captured[0].model
+    observers = [observer for observer in dispatch.observing(model) if observer.backend == 'sql']
+    if observers:
+        kind, _ = write
+        cursor = context['cursor']
+        count = cursor.rowcount
+        if count == 0:
+            # e.g. the UPDATE tried by `save` before the INSERT of a new primary key
+            return result
+        pks = None
+        if kind == 'created':
+            if not many and count == 1 and getattr(cursor, 'lastrowid', None):
+                pks = [cursor.lastrowid]
+        elif not many:
+            pks = filtered_pks(sql, params, model._meta.pk.column)
+            # the filter names the primary keys, not the rows still there
+            if pks is not None and count >= 0 and len(pks) != count:
+                pks = None
+        if count < 0:
+            # the number of rows is not known
+            count = len(pks) if pks else 0
+        for observer in observers:
+            observer.sql_receiver(kind, pks or [], count, using=context['connection'].alias)
+    return result
+
+
+def capture(observer):
+    """
+    start capturing the SQL writes on the table of the model of `observer`,
+    the execute wrapper is added to the connections of the current thread
+    """
+    with _lock:
+        if not _observers:
+            for connection in connections.all():
+                add_execute_wrapper(connection, capture_writes)
+        _observers.setdefault(observer.model._meta.db_table, []).append(observer)
+
+
+def release(observer):
+    """stop capturing the SQL writes on the table of the model of `observer`"""
+    table = observer.model._meta.db_table
+    with _lock:
+        observers = _observers.get(table, [])
+        if observer in observers:
+            observers.remove(observer)
+        if not observers:
+            _observers.pop(table, None)
+        if not _observers:
+            for connection in connections.all():
+                remove_execute_wrapper(connection, capture_writes)
+
+
+class QueryRecorder(object):
+    """
+    Records the number, the total time and the per-table breakdown of the SQL statements
+    run on the connections of the current thread while it is started.
+    Starts and stops are counted, so the same recorder can be shared by several observers.
+    """
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.count_by_table = Counter()
+        self.time_by_table = defaultdict(float)
+        self._starts = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if _internal.depth:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.time += elapsed
+            for table in referenced_tables(sql):
+                self.count_by_table[table] += 1
+                self.time_by_table[table] += elapsed
+
+    def start(self):
+        if self._starts == 0:
+            for connection in connections.all():
+                add_execute_wrapper(connection, self)
+        self._starts += 1
+
+    def stop(self):
+        self._starts -= 1
+        if self._starts == 0:
+            for connection in connections.all():
+                remove_execute_wrapper(connection, self)
+
+    def reset(self):
+        self.count = 0
+        self.time = 0.0
+        self.count_by_table.clear()
+        self.time_by_table.clear()
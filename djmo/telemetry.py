@@ -0,0 +1,153 @@
+"""
+Always-on write telemetry for long-running processes (workers, servers), built on `Observer`.
+Memory is bounded: counters are reset at every flush, recent primary keys are kept in ring buffers
+and the overhead of the receivers in a fixed-size histogram.
+Reports are flushed periodically to pluggable sinks: `LogSink`, `StatsdSink` or any callable.
+
+    observer = TelemetryObserver(SoccerPlayer, sinks=[LogSink()], interval=60, sample_rate=0.1)
+    observer.connect()
+"""
+import bisect
+import logging
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+from .events import KINDS
+from .observer import Observer
+
+_random = random.random
+_perf_counter = time.perf_counter
+# upper bounds in microseconds of the buckets of the overhead histogram, the last bucket is unbounded
+OVERHEAD_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 1000)
+
+
+class TelemetryObserver(Observer):
+    """
+    An observer recording the write rates of a model with bounded memory.
+    Counters are not exact when several threads write at the same time: increments are not locked,
+    to keep the receivers cheap.
+    The overhead histogram times the receiver from its start, the sampling decision included; the dispatch
+    of the signal by Django to the djmo dispatcher is not timed, it is the larger part of the cost of a write
+    (see the README).
+    """
+    def __init__(self, model, sinks=(), interval=60, sample_rate=1.0, recent=100, threads='all', **options):
+        """
+        :param sinks: the callables receiving the reports, see `flush`
+        :param interval: seconds between two flushes, None to flush only by calling `flush`
+        :param sample_rate: the fraction of the writes recorded, the counts of the reports are scaled by it
+        :param recent: the number of recent primary keys kept for each kind of write
+        :param threads: see `Observer`, by default the writes of every thread are observed
+        """
+        options.setdefault('record_queries', False)
+        super(TelemetryObserver, self).__init__(model, threads=threads, **options)
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.counts = dict.fromkeys(KINDS, 0)
+        self.recent = {kind: deque(maxlen=recent) for kind in KINDS}
+        self.overhead = [0] * (len(OVERHEAD_BUCKETS) + 1)
+        self.interval_start = time.time()
+        self._stop = None
+
+    def _sample(self, kind, pk, start):
+        """
+        :param start: the `time.perf_counter()` at the start of the receiver, the sampling decision included
+        """
+        self.counts[kind] += 1
+        self.recent[kind].append(pk)
+        elapsed = (_perf_counter() - start) * 1000000
+        self.overhead[bisect.bisect_left(OVERHEAD_BUCKETS, elapsed)] += 1
+
+    def save_receiver(self, sender, instance=None, created=False, **kwargs):
+        start = _perf_counter()
+        if self.sample_rate < 1 and _random() >= self.sample_rate:
+            return
+        self._sample('created' if created else 'updated', instance.pk, start)
+
+    def delete_receiver(self, sender, instance=None, **kwargs):
+        start = _perf_counter()
+        if self.sample_rate < 1 and _random() >= self.sample_rate:
+            return
+        self._sample('deleted', instance.pk, start)
+
+    def report(self):
+        """
+        :return the report of the current interval, a dictionary with the model label, the interval in seconds,
+            the estimated number of writes and writes per second of each kind, the recent primary keys
+            and the histogram of the overhead of the receivers as `(upper bound in microseconds, count)`
+        """
+        elapsed = max(time.time() - self.interval_start, 1e-6)
+        counts = {kind: int(round(count / self.sample_rate)) if self.sample_rate else 0
+                  for kind, count in self.counts.items()}
+        return {
+            'model': "{}.{}".format(self.model._meta.app_label, self.model._meta.model_name),
+            'interval': elapsed,
+            'counts': counts,
+            'rates': {kind: count / elapsed for kind, count in counts.items()},
+            'recent': {kind: list(pks) for kind, pks in self.recent.items()},
+            'overhead': list(zip(OVERHEAD_BUCKETS + (None,), self.overhead)),
+        }
+
+    def flush(self):
+        """send the report of the current interval to the sinks and start a new interval"""
+        report = self.report()
+        self.counts = dict.fromkeys(KINDS, 0)
+        self.overhead = [0] * (len(OVERHEAD_BUCKETS) + 1)
+        self.interval_start = time.time()
+        for sink in self.sinks:
+            sink(report)
+        return report
+
+    def _flush_periodically(self, stop):
+        while not stop.wait(self.interval):
+            self.flush()
+
+    def connect(self):
+        super(TelemetryObserver, self).connect()
+        if self.interval is not None:
+            self._stop = threading.Event()
+            thread = threading.Thread(target=self._flush_periodically, args=(self._stop,),
+                                      name="djmo-telemetry-{}".format(self.model.__name__))
+            thread.daemon = True
+            thread.start()
+
+    def disconnect(self):
+        """stop observing and flush the last interval"""
+        super(TelemetryObserver, self).disconnect()
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        self.flush()
+
+
+class LogSink(object):
+    """sink writing one log line per report"""
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('djmo.telemetry')
+        self.level = level
+
+    def __call__(self, report):
+        self.logger.log(self.level, "%s writes in %.1fs: %s", report['model'], report['interval'],
+                        " ".join("{}={} ({:.2f}/s)".format(kind, report['counts'][kind], report['rates'][kind])
+                                 for kind in KINDS))
+
+
+class StatsdSink(object):
+    """sink sending the counts as StatsD counters and the rates as gauges, over UDP"""
+    def __init__(self, host='127.0.0.1', port=8125, prefix='djmo'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, report):
+        name = "{}.{}".format(self.prefix, report['model'])
+        lines = ["{}.{}:{}|c".format(name, kind, report['counts'][kind]) for kind in KINDS]
+        lines += ["{}.{}_rate:{:.3f}|g".format(name, kind, report['rates'][kind]) for kind in KINDS]
+        try:
+            self.socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError:
+            # telemetry must never break the observed process
+            pass
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Benchmarks of djmo, run them from the `tests` folder:
+
+    python benchmarks.py [--sizes 10 100 1000 10000 100000] [--output results.json]
+
+They measure, for `SoccerTeam`, `SoccerPlayer` and a generated wide model, as the number of rows grows:
+the overhead of a save with no djmo receiver, with the dispatcher connected but no active observer
+(as once a model has been observed) and with 1 and 10 connected observers,
+the time and the memory (with and without digests) of `observe_instances`,
+the latency of `delta`/`assertDelta` and the cost of the counter properties.
+The micro-benchmark of the serializer path against the field extractor is run on the same rows.
+Results are written as JSON to compare releases.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+OBSERVER_COUNTS = (0, 1, 10)
+REPEAT = 5
+WIDE_MODEL_FIELDS = 80
+# saves and single-instance deltas are measured on at most these many rows: their cost per row does not depend
+# on the size of the table, and one query per row on 100k rows would only measure the database
+MAX_SAVES = 10000
+MAX_SINGLE_DELTAS = 100
+
+
+def best_time(statement, repeat=REPEAT):
+    """:return the best time in seconds of `repeat` executions of `statement`"""
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def wide_model():
+    """:return a generated model with `WIDE_MODEL_FIELDS` columns, its table is created in the test database"""
+    from django.db import connection, models
+
+    attrs = {
+        '__module__': __name__,
+        'Meta': type('Meta', (), {'app_label': 'soccer', 'db_table': 'soccer_benchmark_wide'}),
+    }
+    for i in range(WIDE_MODEL_FIELDS):
+        if i % 4 == 0:
+            attrs['field_{}'.format(i)] = models.TextField(default='text ' * 50)
+        elif i % 2 == 0:
+            attrs['field_{}'.format(i)] = models.CharField(max_length=50, default='value {}'.format(i))
+        else:
+            attrs['field_{}'.format(i)] = models.IntegerField(default=i)
+    model = type('BenchmarkWideRow', (models.Model,), attrs)
+    with connection.schema_editor() as editor:
+        editor.create_model(model)
+    return model
+
+
+def fill(model, size):
+    """replace the rows of `model` with `size` new rows, :return the list of the rows"""
+    from django.db import connection
+    from project_for_tests.apps.soccer.models import SoccerTeam, SoccerPlayer
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(connection.ops.quote_name(model._meta.db_table)))
+    if model is SoccerTeam:
+        objs = [model(name='team {}'.format(i), number_of_supporters=i) for i in range(size)]
+    elif model is SoccerPlayer:
+        team = SoccerTeam.objects.create(name='team', number_of_supporters=0)
+        objs = [model(team=team, first_name='first {}'.format(i), last_name='last {}'.format(i))
+                for i in range(size)]
+    else:
+        objs = [model() for _ in range(size)]
+    model.objects.bulk_create(objs, batch_size=100)
+    return list(model.objects.all())
+
+
+def bench_save_overhead(model, instances):
+    from djmo import dispatch
+    from djmo.observer import Observer
+
+    results = []
+    saved = instances[:MAX_SAVES]
+    for number_of_observers in OBSERVER_COUNTS:
+        # the receivers of the dispatcher stay connected once the model has been observed:
+        # with 0 observers the save is measured both without them and with them
+        for dispatcher_connected in ((False, True) if number_of_observers == 0 else (True,)):
+            if dispatcher_connected:
+                dispatch._connect(model)
+            else:
+                dispatch._disconnect(model)
+            observers = [Observer(model, record_queries=False) for _ in range(number_of_observers)]
+            for observer in observers:
+                observer.connect()
+            try:
+                seconds = best_time(lambda: [instance.save() for instance in saved], repeat=3)
+            finally:
+                for observer in observers:
+                    observer.disconnect()
+            results.append({'benchmark': 'save', 'observers': number_of_observers,
+                            'dispatcher_connected': dispatcher_connected, 'seconds_per_row': seconds / len(saved)})
+    return results
+
+
+def bench_snapshot(model, instances):
+    from djmo.observer import Observer
+
+    def snapshot():
+        Observer(model, record_queries=False).observe_instances(*instances)
+
+    def retained_memory(digest):
+        # the instances are fetched again and dropped, so only the memory kept by the snapshots is measured
+        tracemalloc.start()
+        observer = Observer(model, record_queries=False, digest=digest)
+        before = tracemalloc.get_traced_memory()[0]
+        observer.observe_instances(*model.objects.all())
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return memory
+
+    seconds = best_time(snapshot)
+    return [{'benchmark': 'observe_instances', 'seconds_per_row': seconds / len(instances)}] + [
+        {'benchmark': 'memory', 'digest': digest, 'bytes_per_row': retained_memory(digest) / len(instances)}
+        for digest in (False, True)
+    ]
+
+
+def bench_delta(model, instances):
+    from djmo.observer import Observer
+
+    results = []
+    for batched in (True, False):
+        observer = Observer(model, batched=batched, record_queries=False)
+        observer.observe_instances(*instances)
+        sample = instances if batched else instances[:MAX_SINGLE_DELTAS]
+
+        def deltas():
+            # drop the memoized re-fetch, as a write signal would
+            observer._current_records = None
+            for instance in sample:
+                observer.instance(instance).delta
+
+        def assert_deltas():
+            observer._current_records = None
+            for instance in sample:
+                observer.assertDelta(instance, {})
+
+        results.append({'benchmark': 'delta', 'batched': batched,
+                        'seconds_per_row': best_time(deltas) / len(sample)})
+        results.append({'benchmark': 'assertDelta', 'batched': batched,
+                        'seconds_per_row': best_time(assert_deltas) / len(sample)})
+    return results
+
+
+def bench_counters(model, instances):
+    from djmo.observer import Observer
+
+    observer = Observer(model, record_queries=False)
+    for instance in instances:
+        observer.save_receiver(model, instance=instance, created=False)
+    number = 1000
+    return [
+        {'benchmark': 'counter', 'property': name,
+         'seconds_per_call': min(timeit.repeat(lambda: getattr(observer, name), number=number, repeat=REPEAT)) / number}
+        for name in ('number_of_objects_updated', 'nothing_has_changed')
+    ]
+
+
+def bench_snapshot_and_diff(model, instances):
+    """serializer path (djmo <= 0.0.1) against the precompiled field extractor"""
+    from django.core import serializers
+    from djmo.records import get_extractor
+
+    def serializer_snapshot():
+        return [{(k, tuple(v)) if isinstance(v, list) else (k, v)
+                 for k, v in serializers.serialize('python', [instance])[0]['fields'].items()}
+                for instance in instances]
+
+    extractor = get_extractor(model)
+    serialized = serializer_snapshot()
+    records = [extractor.record(instance) for instance in instances]
+    timings = [
+        ('serializer_snapshot', best_time(serializer_snapshot)),
+        ('extractor_snapshot', best_time(lambda: [extractor.record(instance) for instance in instances])),
+        ('serializer_diff', best_time(lambda: [dict(s - s) for s in serialized])),
+        ('extractor_diff', best_time(lambda: [extractor.diff(r, r) for r in records])),
+    ]
+    return [{'benchmark': name, 'seconds_per_row': seconds / len(instances)} for name, seconds in timings]
+
+
+BENCHMARKS = (bench_save_overhead, bench_snapshot, bench_delta, bench_counters, bench_snapshot_and_diff)
+
+
+def run(sizes):
+    import django
+    from django.db import connection
+    from project_for_tests.apps.soccer.models import SoccerTeam, SoccerPlayer
+
+    connection.creation.create_test_db(verbosity=0)
+    results = []
+    for model in (SoccerTeam, SoccerPlayer, wide_model()):
+        for size in sizes:
+            instances = fill(model, size)
+            for benchmark in BENCHMARKS:
+                for result in benchmark(model, instances):
+                    result.update({'model': model.__name__, 'rows': size})
+                    results.append(result)
+                    print(json.dumps(result, sort_keys=True), file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project_for_tests.settings")
+    # add djmo to PYTHONPATH
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="numbers of rows")
+    parser.add_argument('--output', help="JSON file of the results, standard output if not given")
+    arguments = parser.parse_args()
+
+    import django
+    django.setup()
+
+    report = json.dumps(run(arguments.sizes), indent=2, sort_keys=True)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
@@ -4,9 +4,17 @@ Only for test purpose
 from django.db import models
 
 
+class Sponsor(models.Model):
+    name = models.CharField(max_length=50)
+
+    def __str__(self):
+        return "<Sponsor `{}`>".format(self.name)
+
+
 class SoccerTeam(models.Model):
     name = models.CharField(max_length=50)
     number_of_supporters = models.IntegerField()
+    sponsors = models.ManyToManyField(Sponsor, blank=True)
 
     @property
     def all_players(self):
@@ -1,12 +1,29 @@
+import asyncio
+import io
+import multiprocessing
 import sys
 import os
-from django.test import TestCase
-from .models import SoccerTeam, SoccerPlayer
+import socket
+import tempfile
+import threading
+from contextlib import redirect_stderr
+from unittest import skipIf
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from .models import SoccerTeam, SoccerPlayer, Sponsor
 from django.conf import settings
 # add dynamically djmo to PYTHONPATH
 djmo_root = settings.BASE_DIR[:settings.BASE_DIR.rfind("{}djmo".format(os.sep))]
 sys.path.insert(0, djmo_root)
-from djmo import observe_models
+from djmo import observe, observe_models
+from djmo.cache import SnapshotCache
+from djmo.collector import ENVIRONMENT_VARIABLE, Collector, EventsLost, decode, encode, install, send
+from djmo.dispatch import contextvars
+from djmo.observer import Observer
+from djmo.records import get_extractor
+from djmo.telemetry import StatsdSink, TelemetryObserver
 
 
 class BaseTestCase(TestCase):
@@ -63,6 +80,21 @@ class ObserverTestCase(BaseTestCase):
         self.assertEqual(0, self.observers[SoccerPlayer].number_of_objects_updated)
         self.assertEqual(0, self.observers[SoccerPlayer].number_of_objects_deleted)
 
+    @observe_models(SoccerPlayer)
+    def test_event_store(self):
+        mario_rossi = SoccerPlayer.objects.get(last_name='Rossi')
+        mario_rossi.save()
+        mario_rossi.save()
+        mario_verdi = SoccerPlayer.objects.get(last_name='Verdi')
+        mario_verdi.save()
+        self.assertEqual(2, self.observers[SoccerPlayer].number_of_objects_updated)
+        self.assertEqual(2, self.observers[SoccerPlayer].updated.count(mario_rossi.pk))
+        self.assertIn(mario_verdi.pk, self.observers[SoccerPlayer].updated)
+        self.assertEqual([mario_rossi.pk, mario_verdi.pk], list(self.observers[SoccerPlayer].updated))
+        # the raw ordered event log is still available
+        self.assertEqual([mario_rossi.pk, mario_rossi.pk, mario_verdi.pk],
+                         self.observers[SoccerPlayer].instances_updated)
+
     @observe_models(SoccerPlayer)
     def test_property_observer(self):
         # print(self._testMethodName, "test_property_observer -->", id(self.observers[SoccerPlayer]), threading.current_thread())
@@ -160,19 +192,685 @@ class ObserverTestCase(BaseTestCase):
         mario_verdi.delete()
         self.assertTrue(self.observers[SoccerPlayer].instance(mario_verdi).is_deleted)
 
+    @observe_models(SoccerPlayer, batched=True)
+    def test_batched_observation(self):
+        players = list(SoccerPlayer.objects.all())
+        mario_rossi, mario_verdi, mario_gialli = players
+        self.observers[SoccerPlayer].observe_instances(*players)
+
+        mario_rossi.last_name = "Arancioni"
+        mario_rossi.save()
+        mario_gialli.delete()
+        # all observed instances are re-fetched with a single query
+        with self.assertNumQueries(1):
+            self.assertDictEqual({'last_name': 'Arancioni'}, self.observers[SoccerPlayer].instance(mario_rossi).delta)
+            self.assertDictEqual({}, self.observers[SoccerPlayer].instance(mario_verdi).delta)
+            self.assertTrue(self.observers[SoccerPlayer].instance(mario_gialli).is_deleted)
+            self.observers[SoccerPlayer].assertDelta(mario_rossi, {'last_name': 'Arancioni'})
+
+        # a write signal invalidates the memoized re-fetch
+        mario_verdi.team = self.empty_team
+        mario_verdi.save()
+        self.assertDictEqual({'team': self.empty_team.pk}, self.observers[SoccerPlayer].instance(mario_verdi).delta)
+        self.assertRaises(AssertionError, self.observers[SoccerPlayer].assertDelta, mario_verdi, {})
+
+    def test_batched_observation_not_connected(self):
+        mario_rossi = SoccerPlayer.objects.get(last_name='Rossi')
+        with observe(SoccerPlayer, batched=True) as observers:
+            observers[SoccerPlayer].observe_instance(mario_rossi)
+            self.assertDictEqual({}, observers[SoccerPlayer].instance(mario_rossi).delta)
+        # the writes made after the observation are not received, the re-fetch is not memoized
+        SoccerPlayer.objects.filter(pk=mario_rossi.pk).update(last_name='Arancioni')
+        self.assertDictEqual({'last_name': 'Arancioni'}, observers[SoccerPlayer].instance(mario_rossi).delta)
+
+    @observe_models(SoccerPlayer, batched=True, exclude=['team'])
+    def test_field_subset(self):
+        mario_rossi = SoccerPlayer.objects.only('first_name', 'last_name').get(last_name='Rossi')
+        mario_verdi = SoccerPlayer.objects.get(last_name='Verdi')
+        with self.assertNumQueries(0):
+            self.observers[SoccerPlayer].observe_instances(mario_rossi)
+        self.observers[SoccerPlayer].observe_instance(mario_verdi, fields=['last_name'])
+
+        SoccerPlayer.objects.filter(pk__in=[mario_rossi.pk, mario_verdi.pk]).update(
+            team=self.empty_team, first_name='Luigi')
+        with CaptureQueriesContext(connection) as queries:
+            self.observers[SoccerPlayer].assertDelta(mario_rossi, {'first_name': 'Luigi'})
+            self.assertFalse(self.observers[SoccerPlayer].instance(mario_verdi).is_updated)
+        # one query per observed subset of fields, loading only those columns
+        self.assertEqual(2, len(queries))
+        self.assertNotIn('team_id', queries[0]['sql'] + queries[1]['sql'])
+
+    def test_field_subset_options(self):
+        self.assertEqual(('last_name',), Observer(SoccerPlayer, only=['last_name']).extractor.names)
+        self.assertEqual(('team', 'last_name'), Observer(SoccerPlayer, exclude=['first_name']).extractor.names)
+        self.assertRaises(ValueError, Observer, SoccerPlayer, only=['last_name'], exclude=['team'])
+        self.assertRaises(ValueError, Observer, SoccerPlayer, only=['foo'])
+
+    @observe_models(SoccerPlayer)
+    def test_observe_queryset(self):
+        players = SoccerPlayer.objects.filter(team=self.dream_team)
+        observed = self.observer.observe_queryset(players, fields=['first_name', 'last_name'], chunk_size=2)
+        self.assertFalse(observed.delta.has_changed)
+
+        rossi, verdi, gialli = players.order_by('pk')
+        new_player = SoccerPlayer.objects.create(team=self.dream_team, first_name='Luigi', last_name='Bianchi')
+        rossi.first_name = 'Giulio'
+        rossi.save()
+        verdi.team = self.empty_team  # leaves the queryset
+        verdi.save()
+        gialli_pk = gialli.pk
+        gialli.delete()
+        delta = observed.delta
+        self.assertEqual([new_player.pk], delta.created)
+        self.assertEqual({rossi.pk: {'first_name': 'Giulio'}}, delta.updated)
+        self.assertEqual([verdi.pk, gialli_pk], delta.deleted)
+        observed.assert_delta_is_equal_to(created=[new_player.pk], updated={rossi.pk: {'first_name': 'Giulio'}},
+                                          deleted=[verdi.pk, gialli_pk])
+        self.assertRaises(ValueError, self.observer.observe_queryset, SoccerPlayer.objects.all()[:2])
+        self.assertRaises(ValueError, self.observer.observe_queryset, SoccerPlayer.objects.all()[1:])
+
+    @observe_models(SoccerPlayer, transactional=True)
+    def test_transactional_observation(self):
+        rossi = SoccerPlayer.objects.get(last_name='Rossi')
+        verdi = SoccerPlayer.objects.get(last_name='Verdi')
+        with transaction.atomic():
+            player = SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+            for _ in range(3):
+                player.save()
+            SoccerPlayer.objects.create(team=self.dream_team, first_name='c', last_name='d').delete()
+            rossi.save()
+            # not recorded before the commit
+            self.assertTrue(self.observer.nothing_has_changed)
+        self.assertEqual([player.pk], self.observer.instances_created)
+        self.assertEqual([rossi.pk], self.observer.instances_updated)
+        self.assertEqual([], self.observer.instances_deleted)
+
+        self.observer.reset()
+        try:
+            with transaction.atomic():
+                SoccerPlayer.objects.create(team=self.dream_team, first_name='e', last_name='f')
+                rossi.delete()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(self.observer.nothing_has_changed)
+
+        # nested blocks: the rolled back savepoint is thrown away, the released one is merged in its parent
+        with transaction.atomic():
+            with transaction.atomic():
+                other = SoccerPlayer.objects.create(team=self.dream_team, first_name='g', last_name='h')
+            try:
+                with transaction.atomic():
+                    verdi.delete()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual([other.pk], self.observer.instances_created)
+        self.assertEqual(0, self.observer.number_of_objects_deleted)
+
+    def test_write_sites_profile(self):
+        def save_twice(player):
+            player.save()
+            player.save()
+
+        output = io.StringIO()
+        with redirect_stderr(output):
+            with observe(SoccerPlayer, profile=True) as observers:
+                for player in SoccerPlayer.objects.all():
+                    save_twice(player)
+                self.perform_some_actions()
+        ranked = observers[SoccerPlayer].profiler.ranked()
+        # one call site per line of `save_twice`, then the lines of `perform_some_actions`
+        for (filename, line, function), counts, seconds in ranked[:2]:
+            self.assertEqual((__file__.rstrip('c'), 'save_twice'), (filename, function))
+            self.assertEqual({'created': 0, 'updated': 3, 'deleted': 0}, counts)
+        self.assertEqual({'perform_some_actions'}, {function for (_, _, function), _, _ in ranked[2:]})
+        self.assertIn("save_twice", output.getvalue())
+
+    def test_snapshot_cache(self):
+        cache = SnapshotCache()
+        players = SoccerPlayer.objects.all()
+        Observer(SoccerPlayer, cache=cache).observe_queryset(players)
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+        observed = Observer(SoccerPlayer, cache=cache).observe_queryset(players)
+        self.assertEqual((3, 3), (cache.hits, cache.misses))
+
+        # only the changed row is read again
+        SoccerPlayer.objects.filter(last_name='Rossi').update(first_name='Giulio')
+        rossi = SoccerPlayer.objects.get(last_name='Rossi')
+        self.assertEqual({rossi.pk: {'first_name': 'Giulio'}}, observed.delta.updated)
+        self.assertEqual((5, 4), (cache.hits, cache.misses))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshots')
+            cache.path = path
+            cache.save()
+            cache = SnapshotCache(path)
+            self.assertEqual(3, len(cache))
+            Observer(SoccerPlayer, cache=cache).observe_queryset(players)
+            self.assertEqual((3, 0), (cache.hits, cache.misses))
+
+    @observe_models(SoccerTeam, SoccerPlayer)
+    def test_related_graph(self):
+        acme = Sponsor.objects.create(name='Acme')
+        self.dream_team.sponsors.add(acme)
+        teams = list(SoccerTeam.objects.all())
+        # one query per relation for all the teams
+        with self.assertNumQueries(2):
+            self.observers[SoccerTeam].observe_instances(*teams, follow=['soccerplayer_set', 'sponsors'])
+        self.assertFalse(self.observers[SoccerTeam].graph_delta(self.dream_team).has_changed)
+
+        rossi, verdi = SoccerPlayer.objects.get(last_name='Rossi'), SoccerPlayer.objects.get(last_name='Verdi')
+        self.observers[SoccerPlayer].observe_instance(rossi, follow=['team'])
+        rossi.first_name = 'Giulio'
+        rossi.save()
+        verdi.team = self.empty_team
+        verdi.save()
+        new_player = SoccerPlayer.objects.create(team=self.dream_team, first_name='Luigi', last_name='Bianchi')
+        self.dream_team.number_of_supporters = 1
+        self.dream_team.save()
+        acme.name = 'Acme Corporation'
+        acme.save()
+
+        with self.assertNumQueries(3):
+            deltas = self.observers[SoccerTeam].graph_delta()
+        dream_team = deltas[('default', self.dream_team.pk)]
+        self.assertEqual({'number_of_supporters': 1}, dream_team.fields)
+        players = dream_team.related['soccerplayer_set']
+        self.assertEqual(([new_player.pk], [verdi.pk]), (players.created, players.deleted))
+        self.assertEqual({rossi.pk: {'first_name': 'Giulio'}}, players.updated)
+        self.assertEqual({acme.pk: {'name': 'Acme Corporation'}}, dream_team.related['sponsors'].updated)
+        self.assertEqual([verdi.pk], deltas[('default', self.empty_team.pk)].related['soccerplayer_set'].created)
+        rossi_delta = self.observers[SoccerPlayer].graph_delta(rossi)
+        self.assertEqual({'number_of_supporters': 1}, rossi_delta.related['team'].updated[self.dream_team.pk])
+        self.assertRaises(ValueError, self.observers[SoccerTeam].observe_instance, self.dream_team, follow=['foo'])
+
+    @skipIf(not hasattr(socket, 'AF_UNIX'), "Unix sockets are required")
+    def test_collector(self):
+        def worker():
+            install([SoccerPlayer])
+            player = SoccerPlayer(pk=1000, first_name='Luigi', last_name='Bianchi')
+            post_save.send(SoccerPlayer, instance=player, created=True, using='default')
+            post_save.send(SoccerPlayer, instance=player, created=False, using='default')
+            post_delete.send(SoccerPlayer, instance=player, using='default')
+
+        with Collector() as djmo_collector:
+            self.assertEqual(djmo_collector.path, os.environ[ENVIRONMENT_VARIABLE])
+            with observe(SoccerPlayer, collector=djmo_collector) as observers:
+                process = multiprocessing.get_context('fork').Process(target=worker)
+                process.start()
+                process.join()
+                observer = observers[SoccerPlayer]
+                self.assertEqual([1000], observer.instances_created)
+                self.assertEqual([1000], observer.instances_updated)
+                self.assertEqual([1000], observer.instances_deleted)
+                self.assertEqual([1000], observer.events('default')['created'].log)
+            self.assertEqual(3, djmo_collector.received)
+        self.assertNotIn(ENVIRONMENT_VARIABLE, os.environ)
+        self.assertEqual(('updated', 'soccer.soccerplayer', 'shard', 'a-key', 42, 7),
+                         decode(encode('updated', 'soccer.soccerplayer', 'shard', 'a-key', 42, 7)))
+
+    @skipIf(not hasattr(socket, 'AF_UNIX'), "Unix sockets are required")
+    def test_collector_burst_and_lost_events(self):
+        def worker():
+            for pk in range(5000):
+                send('created', SoccerPlayer, pk, 'default')
+
+        with Collector() as djmo_collector:
+            with observe(SoccerPlayer, collector=djmo_collector) as observers:
+                # far more events than the queue of the socket holds: the worker waits for the collector
+                process = multiprocessing.get_context('fork').Process(target=worker)
+                process.start()
+                process.join()
+                self.assertEqual(5000, observers[SoccerPlayer].number_of_objects_created)
+
+                # the events 1 and 2 of a worker did not reach the collector
+                worker_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                for sequence in (0, 3):
+                    worker_socket.sendto(encode('updated', 'soccer.soccerplayer', 'default', 1, 1, sequence),
+                                         djmo_collector.path)
+                worker_socket.close()
+                with self.assertRaises(EventsLost):
+                    observers[SoccerPlayer].number_of_objects_updated
+            self.assertEqual(2, djmo_collector.lost)
+
+    def test_incremental_deltas(self):
+        observer = Observer(SoccerPlayer, incremental=True)
+        rossi, verdi, gialli = SoccerPlayer.objects.order_by('pk')
+        # observed before `connect`: its writes until then are unknown, it is re-fetched
+        observer.observe_instance(rossi)
+        self.assertFalse(observer.instance(rossi).is_tracked)
+        observer.connect()
+        observer.observe_instances(rossi, verdi, gialli)
+        rossi.first_name = 'Giulio'
+        rossi.save()
+        verdi.first_name, verdi.last_name = 'Luigi', 'Bianchi'
+        verdi.save(update_fields=['last_name'])
+        gialli_pk = gialli.pk
+        gialli.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual({'first_name': 'Giulio'}, observer.instance(rossi).delta)
+            self.assertEqual({'last_name': 'Bianchi'}, observer.instance(verdi).delta)
+            self.assertTrue(observer.instance(verdi).is_updated)
+            self.assertTrue(observer.observed_instances[('default', gialli_pk)].is_deleted)
+
+        # written without signals: found by `verify`, or re-fetched if the observer captures the bulk writes
+        SoccerPlayer.objects.filter(pk=rossi.pk).update(last_name='Neri')
+        with self.assertNumQueries(1):
+            self.assertEqual({('default', rossi.pk): {'last_name': 'Neri'}}, observer.verify())
+        observer.assertDelta(rossi, {'first_name': 'Giulio', 'last_name': 'Neri'}, verify=True)
+        observer.disconnect()
+        # the writes made after `disconnect` are not received, the instances are re-fetched
+        SoccerPlayer.objects.filter(pk=verdi.pk).update(first_name='Mario', last_name='Verdi')
+        self.assertFalse(observer.instance(verdi).is_updated)
+        self.assertRaises(ValueError, Observer(SoccerPlayer).verify)
+
+    @observe_models(SoccerPlayer)
+    def test_bulk_writes_are_not_captured_by_default(self):
+        SoccerPlayer.objects.filter(last_name='Rossi').update(first_name='Giulio')
+        self.assertTrue(self.observers[SoccerPlayer].nothing_has_changed)
+
+    @observe_models(SoccerPlayer, capture_bulk=True)
+    def test_capture_bulk_writes(self):
+        SoccerPlayer.objects.bulk_create([
+            SoccerPlayer(team=self.dream_team, first_name='Luigi', last_name='Bianchi'),
+            SoccerPlayer(team=self.dream_team, first_name='Luigi', last_name='Neri'),
+        ])
+        self.assertEqual(2, self.observers[SoccerPlayer].number_of_objects_created)
+
+        # evaluated queryset: primary keys are known
+        queryset = SoccerPlayer.objects.filter(last_name='Rossi')
+        mario_rossi = list(queryset)[0]
+        queryset.update(first_name='Giulio')
+        self.assertTrue(self.observers[SoccerPlayer].instance(mario_rossi).is_updated)
+
+        # not evaluated queryset: only the number of rows and the filter are recorded
+        SoccerPlayer.objects.filter(first_name='Luigi').update(first_name='Luca')
+        self.assertEqual(3, self.observers[SoccerPlayer].number_of_objects_updated)
+        batch_event = self.observers[SoccerPlayer].batch_events[-1]
+        self.assertEqual(('updated', [], 2), (batch_event.kind, batch_event.pks, batch_event.count))
+        self.assertIn('Luigi', batch_event.filter)
+
+        # the observer receives `post_delete`, so Django deletes the rows one by one sending the signal
+        SoccerPlayer.objects.filter(first_name='Luca').delete()
+        self.assertEqual(2, self.observers[SoccerPlayer].number_of_objects_deleted)
+        self.assertEqual(3, len(self.observers[SoccerPlayer].batch_events))
+
+        self.observers[SoccerPlayer].reset()
+        self.assertTrue(self.observers[SoccerPlayer].nothing_has_changed)
+        self.assertEqual([], self.observers[SoccerPlayer].batch_events)
+
+    @observe_models(SoccerPlayer, capture_bulk=True)
+    def test_capture_bulk_update_of_stale_queryset(self):
+        queryset = SoccerPlayer.objects.filter(last_name='Rossi')
+        list(queryset)
+        SoccerPlayer.objects.filter(last_name='Rossi').update(last_name='Neri')
+        self.observers[SoccerPlayer].reset()
+        # the cached row does not match the filter anymore
+        self.assertEqual(0, queryset.update(first_name='Giulio'))
+        self.assertEqual([], self.observers[SoccerPlayer].instances_updated)
+        self.assertEqual(0, self.observers[SoccerPlayer].batch_events[-1].count)
+
+    @observe_models(SoccerPlayer, capture_bulk=True)
+    def test_capture_bulk_update_of_values(self):
+        queryset = SoccerPlayer.objects.filter(first_name='Mario').values_list('id', flat=True)
+        list(queryset)
+        queryset.update(first_name='Giulio')
+        self.assertEqual(3, SoccerPlayer.objects.filter(first_name='Giulio').count())
+        batch_event = self.observers[SoccerPlayer].batch_events[-1]
+        self.assertEqual(('updated', [], 3), (batch_event.kind, batch_event.pks, batch_event.count))
+
+    @observe_models(SoccerPlayer, backend='sql')
+    def test_sql_backend(self):
+        self.perform_some_actions()
+        self.assertEqual(3, self.observers[SoccerPlayer].number_of_objects_created)
+        self.assertEqual(2, self.observers[SoccerPlayer].number_of_objects_updated)
+        self.assertEqual(1, self.observers[SoccerPlayer].number_of_objects_deleted)
+
+        # writes that do not send signals are captured too
+        self.observers[SoccerPlayer].reset()
+        SoccerPlayer.objects.filter(first_name='Mario').update(last_name='Bros')
+        self.assertEqual(4, self.observers[SoccerPlayer].number_of_objects_updated)
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM soccer_soccerplayer WHERE last_name = %s", ['Bros'])
+        self.assertEqual(4, self.observers[SoccerPlayer].number_of_objects_deleted)
+        # only the table of the observed model is captured
+        SoccerTeam.objects.create(name='other team', number_of_supporters=400)
+        self.assertEqual(0, self.observers[SoccerPlayer].number_of_objects_created)
+
+        # statements changing no row are not recorded: `save` of a new primary key runs an UPDATE before the INSERT
+        self.observers[SoccerPlayer].reset()
+        SoccerPlayer.objects.filter(pk=99999).update(last_name='Nobody')
+        SoccerPlayer(pk=5000, team=self.dream_team, first_name='Luigi', last_name='Bianchi').save()
+        self.assertEqual([5000], self.observers[SoccerPlayer].instances_created)
+        self.assertEqual([], self.observers[SoccerPlayer].instances_updated)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, Observer, SoccerPlayer, backend='foo')
+
+    @observe_models(SoccerTeam, Sponsor)
+    def test_relation_delta(self):
+        acme, globex, initech = [Sponsor.objects.create(name=name) for name in ('Acme', 'Globex', 'Initech')]
+        self.empty_team.sponsors.add(acme)
+        self.observers.reset()
+
+        self.dream_team.sponsors.add(acme, globex)
+        self.dream_team.sponsors.remove(globex)
+        initech.soccerteam_set.add(self.dream_team)
+        self.empty_team.sponsors.remove(acme)
+
+        delta = self.observers[SoccerTeam].relation_delta(self.dream_team, 'sponsors')
+        self.assertEqual(({acme.pk, initech.pk}, set(), False), (delta.added, delta.removed, delta.cleared))
+        delta = self.observers[SoccerTeam].relation_delta(self.empty_team, 'sponsors')
+        self.assertEqual((set(), {acme.pk}), (delta.added, delta.removed))
+        # reverse relation
+        delta = self.observers[Sponsor].relation_delta(acme, 'soccerteam_set')
+        self.assertEqual(({self.dream_team.pk}, {self.empty_team.pk}), (delta.added, delta.removed))
+        self.assertFalse(self.observers[Sponsor].relation_delta(globex, 'soccerteam_set').has_changed)
+
+        # the payload of a clear does not contain the removed objects
+        self.dream_team.sponsors.clear()
+        delta = self.observers[SoccerTeam].relation_delta(self.dream_team, 'sponsors')
+        self.assertEqual((set(), True), (delta.added, delta.cleared))
+        # they are read before the clear for the observers of the other side
+        delta = self.observers[Sponsor].relation_delta(acme, 'soccerteam_set')
+        self.assertEqual((set(), {self.empty_team.pk}), (delta.added, delta.removed))
+        delta = self.observers[Sponsor].relation_delta(initech, 'soccerteam_set')
+        self.assertFalse(delta.has_changed)
+
     @observe_models(SoccerPlayer)
     def test_assertModelIsUntouched_method(self):
         self.observers[SoccerPlayer].assertModelIsUntouched()  # check that this method does not raise an error
         self.perform_some_actions()
         self.assertRaises(Exception, self.observers[SoccerPlayer].assertModelIsUntouched)
 
+    def test_fingerprint(self):
+        def raw_update(sql, *params):
+            # as another process would do, without signals
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+        with observe(SoccerPlayer, SoccerTeam) as observers:
+            with observe(SoccerPlayer, fingerprint=True) as fingerprinted:
+                with observe(SoccerTeam, fingerprint=['name']) as fingerprinted_names:
+                    self.assertEqual(3, fingerprinted[SoccerPlayer].fingerprint.count)
+                    raw_update("UPDATE soccer_soccerplayer SET first_name = %s WHERE last_name = %s", 'Luigi', 'Rossi')
+                    raw_update("UPDATE soccer_soccerteam SET number_of_supporters = 0")
+        self.assertTrue(observers.nothing_has_changed)
+        self.assertFalse(fingerprinted.nothing_has_changed)
+        self.assertRaises(AssertionError, fingerprinted[SoccerPlayer].assertModelIsUntouched)
+        # only the name of the teams is in the checksum
+        self.assertTrue(fingerprinted_names.nothing_has_changed)
+        raw_update("UPDATE soccer_soccerteam SET name = %s WHERE id = %s", 'Nightmare Team', self.dream_team.pk)
+        self.assertFalse(fingerprinted_names.nothing_has_changed)
+        fingerprinted_names.reset()
+        self.assertTrue(fingerprinted_names.nothing_has_changed)
+
+        # the fingerprint queries are not recorded, also with a recorder shared by several observers
+        with observe(SoccerTeam, SoccerPlayer, fingerprint=True) as fingerprinted:
+            self.assertTrue(fingerprinted.nothing_has_changed)
+        self.assertEqual(0, fingerprinted.queries.count)
+
+
+class FieldExtractorTestCase(BaseTestCase):
+    """tests for class FieldExtractor"""
+
+    def test_records_and_diff(self):
+        extractor = get_extractor(SoccerPlayer)
+        self.assertIs(extractor, get_extractor(SoccerPlayer))
+        self.assertEqual(('team', 'first_name', 'last_name'), extractor.names)
+
+        mario_rossi = SoccerPlayer.objects.get(last_name='Rossi')
+        old_record = extractor.record(mario_rossi)
+        self.assertEqual((self.dream_team.pk, 'Mario', 'Rossi'), old_record)
+        mario_rossi.team = self.empty_team
+        mario_rossi.save()
+        new_record = extractor.fetch([mario_rossi.pk])[mario_rossi.pk]
+        self.assertDictEqual({'team': self.empty_team.pk}, extractor.diff(old_record, new_record))
+        self.assertDictEqual({}, extractor.diff(new_record, new_record))
+
+    def test_digests(self):
+        extractor = get_extractor(SoccerTeam)
+        digest = extractor.digest(('Dream Team', -1))
+        self.assertEqual(16, len(digest))
+        self.assertDictEqual({}, extractor.digest_diff(digest, ('Dream Team', -1)))
+        self.assertDictEqual({'number_of_supporters': -2}, extractor.digest_diff(digest, ('Dream Team', -2)))
+
+    @observe_models(SoccerTeam, digest=True)
+    def test_digest_observation(self):
+        self.observer.observe_instance(self.dream_team)
+        observed = self.observer.observe_queryset(SoccerTeam.objects.all())
+        self.assertFalse(self.observer.instance(self.dream_team).is_updated)
+        self.dream_team.name = 'Nightmare Team'
+        self.dream_team.save()
+        self.observer.assertDelta(self.dream_team, {'name': 'Nightmare Team'})
+        self.assertEqual({self.dream_team.pk: {'name': 'Nightmare Team'}}, observed.delta.updated)
+
 
 class ObserversListTestCase(BaseTestCase):
     """tests for class ObserversList"""
 
+    @observe_models(SoccerPlayer, SoccerTeam)
+    def test_query_budget(self):
+        list(SoccerTeam.objects.all())
+        for player in SoccerPlayer.objects.all():
+            player.team  # one query per player
+        self.assertEqual(1 + 1 + 3, self.observers.queries.count)
+        self.assertEqual(1, self.observers.queries.count_by_table['soccer_soccerplayer'])
+        self.assertEqual(4, self.observers.queries.count_by_table['soccer_soccerteam'])
+        self.observers.assertMaxQueries(SoccerPlayer, 1)
+        self.assertRaises(AssertionError, self.observers.assertMaxQueries, SoccerTeam, 3)
+        self.soccerteam_observer.assertMaxQueries(4)
+        self.observers.assertQueryTimeBelow(1000)
+        self.assertRaises(AssertionError, self.observers.assertQueryTimeBelow, 0)
+
+        self.observers.reset()
+        self.assertEqual(0, self.observers.queries.count)
+
+    def test_internal_queries_are_not_recorded(self):
+        with observe(SoccerTeam, SoccerPlayer, fingerprint=True, batched=True) as observers:
+            rossi = SoccerPlayer.objects.get(last_name='Rossi')
+            observers[SoccerPlayer].observe_instance(rossi)
+            self.assertTrue(observers.nothing_has_changed)
+            observers[SoccerPlayer].assertDelta(rossi, {})
+            observers[SoccerPlayer].observe_queryset(SoccerPlayer.objects.all()).delta
+        self.assertEqual(1, observers.queries.count)
+        observers.assertMaxQueries(SoccerPlayer, 1)
+        self.assertRaises(ValueError, Observer(SoccerPlayer, record_queries=False).assertMaxQueries, 1)
+        self.assertRaises(ValueError, Observer(SoccerPlayer, record_queries=False).assertQueryTimeBelow, 1)
+
     @observe_models(SoccerPlayer, SoccerTeam)
     def test_reset_and_nothing_has_changed_method(self):
         self.perform_some_actions()
         self.assertFalse(self.observers.nothing_has_changed)
         self.observers.reset()
         self.assertTrue(self.observers.nothing_has_changed)
+
+
+class ObserveContextManagerTestCase(BaseTestCase):
+    """tests for context manager observe"""
+
+    def test_with_statement(self):
+        with observe(SoccerPlayer, SoccerTeam) as observers:
+            self.perform_some_actions()
+            with observe(SoccerTeam) as team_observers:
+                SoccerTeam.objects.create(name='other team', number_of_supporters=400)
+        # writes after the end of the observation are ignored
+        SoccerTeam.objects.create(name='another team', number_of_supporters=400)
+        self.assertEqual(3, observers[SoccerPlayer].number_of_objects_created)
+        self.assertEqual(2, observers[SoccerTeam].number_of_objects_created)
+        self.assertEqual(1, team_observers[SoccerTeam].number_of_objects_created)
+
+    @skipIf(contextvars is None, "observers are scoped to the current thread on Python < 3.7")
+    def test_async_with_statement(self):
+        async def create_players(number_of_players):
+            async with observe(SoccerPlayer) as observers:
+                for i in range(number_of_players):
+                    SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name=str(i))
+                    await asyncio.sleep(0)
+            return observers[SoccerPlayer].number_of_objects_created
+
+        async def run_concurrently():
+            return await asyncio.gather(create_players(2), create_players(3))
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(run_concurrently())
+        finally:
+            loop.close()
+        # concurrent tasks observe only their own writes
+        self.assertEqual([2, 3], results)
+
+    @observe_models(SoccerPlayer)
+    async def async_observed(self):
+        SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+        return self.observer.number_of_objects_created
+
+    def test_decorated_coroutine(self):
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(1, loop.run_until_complete(self.async_observed()))
+        finally:
+            loop.close()
+
+
+class ThreadsTestCase(BaseTestCase):
+    """tests for the `threads` option of Observer"""
+
+    @staticmethod
+    def sender_thread(*pks):
+        """:return a thread sending `post_save` for new players with the given primary keys"""
+        def send():
+            for pk in pks:
+                post_save.send(sender=SoccerPlayer, instance=SoccerPlayer(pk=pk), created=True)
+        return threading.Thread(target=send)
+
+    def test_threads_option(self):
+        worker, other_worker = self.sender_thread(1001), self.sender_thread(1002, 1003)
+        with observe(SoccerPlayer) as context_observers, \
+                observe(SoccerPlayer, threads='all') as all_observers, \
+                observe(SoccerPlayer, threads='current') as current_observers, \
+                observe(SoccerPlayer, threads=[worker]) as worker_observers:
+            SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+            for thread in (worker, other_worker):
+                thread.start()
+                thread.join()
+        self.assertEqual(1, context_observers[SoccerPlayer].number_of_objects_created)
+        self.assertEqual(4, all_observers[SoccerPlayer].number_of_objects_created)
+        self.assertEqual(1, current_observers[SoccerPlayer].number_of_objects_created)
+        self.assertEqual([1001], list(worker_observers[SoccerPlayer].created))
+
+    def test_concurrent_writes(self):
+        with observe(SoccerPlayer, threads='all') as observers:
+            def send():
+                for pk in range(1000):
+                    post_save.send(sender=SoccerPlayer, instance=SoccerPlayer(pk=pk), created=False)
+            threads = [threading.Thread(target=send) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1000, observers[SoccerPlayer].number_of_objects_updated)
+        self.assertEqual(8, observers[SoccerPlayer].updated.count(500))
+        self.assertEqual(8000, len(observers[SoccerPlayer].instances_updated))
+
+
+class TelemetryTestCase(BaseTestCase):
+    """tests for class TelemetryObserver"""
+
+    def test_reports(self):
+        reports = []
+        observer = TelemetryObserver(SoccerPlayer, sinks=[reports.append], interval=None, recent=2)
+        observer.connect()
+        players = [SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name=str(i))
+                   for i in range(3)]
+        players[0].delete()
+        report = observer.flush()
+        self.assertEqual({'created': 3, 'updated': 0, 'deleted': 1}, report['counts'])
+        self.assertEqual([players[1].pk, players[2].pk], report['recent']['created'])
+        self.assertEqual(4, sum(count for _, count in report['overhead']))
+        # counters are reset at every flush, the last interval is flushed by disconnect
+        SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+        observer.disconnect()
+        SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+        self.assertEqual([report, reports[1]], reports)
+        self.assertEqual(1, reports[1]['counts']['created'])
+
+    def test_sampling(self):
+        observer = TelemetryObserver(SoccerPlayer, interval=None, sample_rate=0)
+        observer.connect()
+        SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+        observer.disconnect()
+        self.assertEqual(0, observer.report()['counts']['created'])
+
+    def test_periodic_flush_to_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        observer = TelemetryObserver(SoccerPlayer, sinks=[StatsdSink(port=server.getsockname()[1])], interval=0.01)
+        observer.connect()
+        try:
+            SoccerPlayer.objects.create(team=self.dream_team, first_name='a', last_name='b')
+            lines = server.recv(4096).decode().split()
+        finally:
+            observer.disconnect()
+            server.close()
+        self.assertIn('djmo.soccer.soccerplayer.updated:0|c', lines)
+
+
+class MultiDatabaseTestCase(TransactionTestCase):
+    """tests for the observation of several databases"""
+    multi_db = True
+    databases = '__all__'
+
+    def setUp(self):
+        self.players = dict()
+        for using in ('default', 'shard'):
+            team = SoccerTeam.objects.using(using).create(name='Dream Team', number_of_supporters=58000)
+            self.players[using] = SoccerPlayer.objects.using(using).create(
+                team=team, first_name='Mario', last_name='Rossi')
+
+    def test_events_and_deltas_per_database(self):
+        default_player, shard_player = self.players['default'], self.players['shard']
+        with observe(SoccerPlayer, batched=True) as observers:
+            observer = observers[SoccerPlayer]
+            observer.observe_instances(default_player, shard_player)
+            shard_player.first_name = 'Luigi'
+            shard_player.save()
+            # one query per database
+            with self.assertNumQueries(1, using='default'), self.assertNumQueries(1, using='shard'):
+                observer.assertDelta(default_player, {})
+                observer.assertDelta(shard_player, {'first_name': 'Luigi'})
+        self.assertEqual([shard_player.pk], observer.events('shard')['updated'].log)
+        self.assertEqual(0, len(observer.events('default')['updated']))
+        self.assertFalse(observer.instance(default_player).is_updated)
+
+    def test_relation_deltas_per_database(self):
+        teams = dict()
+        with observe(SoccerTeam) as observers:
+            # the same primary key on both databases
+            for using, sponsor_pk in (('default', 1), ('shard', 2)):
+                team = SoccerTeam.objects.using(using).create(pk=100, name='Twin Team', number_of_supporters=0)
+                team.sponsors.add(Sponsor.objects.using(using).create(pk=sponsor_pk, name='Acme'))
+                teams[using] = team
+        self.assertEqual({1}, observers[SoccerTeam].relation_delta(teams['default'], 'sponsors').added)
+        self.assertEqual({2}, observers[SoccerTeam].relation_delta(teams['shard'], 'sponsors').added)
+
+    def test_snapshot_cache_per_database(self):
+        SoccerPlayer.objects.using('shard').update(first_name='Luigi')
+        cache = SnapshotCache()
+        observer = Observer(SoccerPlayer, cache=cache, only=['first_name'])
+        for using, first_name in (('default', 'Mario'), ('shard', 'Luigi')):
+            observed = observer.observe_queryset(SoccerPlayer.objects.using(using).all())
+            self.assertEqual([(first_name,)], observed.records)
+        self.assertEqual(2, len(cache))
+
+    def test_concurrent_fetch(self):
+        observer = Observer(SoccerPlayer, max_workers=2)
+        observer.observe_instances(*self.players.values(), follow=['team'])
+        SoccerTeam.objects.using('shard').update(name='Shard Team')
+        deltas = {using: observer.graph_delta(player) for using, player in self.players.items()}
+        self.assertFalse(deltas['default'].has_changed)
+        self.assertEqual({'name': 'Shard Team'}, list(deltas['shard'].related['team'].updated.values())[0])
+        deltas = observer.graph_delta()
+        self.assertEqual({('default', self.players['default'].pk), ('shard', self.players['shard'].pk)}, set(deltas))
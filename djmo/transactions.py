@@ -0,0 +1,98 @@
+"""
+Transaction-aware buffering of the events of the observers created with `transactional=True`.
+The events received inside an atomic block are buffered per block and coalesced per primary key;
+when the block exits the buffer is merged into the enclosing block, or recorded if the enclosing block
+is the one active when the observer connected, and thrown away if the block is rolled back.
+`Atomic.__exit__` is wrapped while at least one observer is transactional.
+"""
+import threading
+from collections import OrderedDict
+
+from django.db import transaction
+
+# transactional observers, receiving the exits of the atomic blocks
+_observers = []
+_originals = dict()
+_lock = threading.Lock()
+
+# (net change, new event) -> net change, None when they cancel out
+_COALESCE = {
+    ('created', 'created'): 'created',
+    ('created', 'updated'): 'created',
+    ('created', 'deleted'): None,
+    ('updated', 'created'): 'updated',
+    ('updated', 'updated'): 'updated',
+    ('updated', 'deleted'): 'deleted',
+    ('deleted', 'created'): 'updated',
+    ('deleted', 'updated'): 'updated',
+    ('deleted', 'deleted'): 'deleted',
+}
+
+
+def depth(connection):
+    """:return the number of atomic blocks open on `connection`"""
+    if not connection.in_atomic_block:
+        return 0
+    return len(connection.savepoint_ids) + 1
+
+
+class TransactionBuffer(object):
+    """the net change of each primary key written inside one atomic block, in order of first write"""
+    def __init__(self):
+        self.changes = OrderedDict()
+
+    def add(self, kind, pk):
+        if pk not in self.changes:
+            self.changes[pk] = kind
+            return
+        change = _COALESCE[(self.changes[pk], kind)]
+        if change is None:
+            del self.changes[pk]
+        else:
+            self.changes[pk] = change
+
+    def merge(self, buffer):
+        """add the net changes of the buffer of a nested block"""
+        for pk, kind in buffer.changes.items():
+            self.add(kind, pk)
+
+    def __iter__(self):
+        """iterate over `(kind, pk)`"""
+        return ((kind, pk) for pk, kind in self.changes.items())
+
+    def __len__(self):
+        return len(self.changes)
+
+
+def _exit(self, exc_type, exc_value, traceback):
+    connection = transaction.get_connection(self.using)
+    block_depth = depth(connection)
+    committed = exc_type is None and not connection.needs_rollback
+    try:
+        result = _originals['__exit__'](self, exc_type, exc_value, traceback)
+    except Exception:
+        # the commit or the release of the savepoint failed
+        committed = False
+        raise
+    finally:
+        for observer in list(_observers):
+            observer.atomic_exit(connection.alias, block_depth, committed)
+    return result
+
+
+def capture(observer):
+    """start buffering the events of `observer` per atomic block"""
+    with _lock:
+        if not _observers:
+            _originals['__exit__'] = transaction.Atomic.__exit__
+            transaction.Atomic.__exit__ = _exit
+        _observers.append(observer)
+
+
+def release(observer):
+    """stop buffering the events of `observer`"""
+    with _lock:
+        if observer in _observers:
+            _observers.remove(observer)
+        if not _observers and _originals:
+            transaction.Atomic.__exit__ = _originals.pop('__exit__')